@@ -26,21 +26,150 @@ import os
 import sys
 import gzip
 import bz2
-from collections import namedtuple
+import zlib
+try:
+    import lzma
+except ImportError:  # pragma: no cover
+    lzma = None
+import json
+import mmap
+import errno
+import shlex
+import threading
+import time
+import traceback
+from collections import namedtuple, OrderedDict, deque
+from contextlib import contextmanager
+from functools import partial, reduce
+import inspect
 from inspect import getargspec
 from textwrap import wrap
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+try:
+    from time import perf_counter as clock
+except ImportError:  # pragma: no cover
+    from time import time as clock
 
 
 __version__ = '1.3'
 
+# The default size of the buffers of openinput() and openoutput(). Large
+# buffers mean fewer system calls when reading big files.
+BUFFER_SIZE = 1 << 20
+
+# Baker.output() writes the items of a streamed return value in batches of
+# about this many characters, and at least every OUTPUT_INTERVAL seconds
+OUTPUT_BATCH = 1 << 16
+OUTPUT_INTERVAL = 1.0
+
+# The events that callbacks can be registered for with Baker.on()
+HOOK_EVENTS = ("after_import", "after_parse", "after_global_apply",
+               "after_apply", "after_output")
+
+# Options handled by Baker itself rather than by a command. They are only
+# recognized before the command name, so commands can have options with the
+# same names.
+RESERVED_OPTIONS = ("--baker-profile", "--baker-sample", "--baker-mem")
+
+# The exit status of a process killed by SIGPIPE, which a command exits with
+# when the reader of its output goes away, e.g. "script.py dump | head"
+EXIT_SIGPIPE = 128 + 13
+
+# Leading bytes identifying the compressed formats openinput() can read
+MAGIC = ((b"\x1f\x8b", "gzip"), (b"BZh", "bz2"), (b"\xfd7zXZ\x00", "xz"))
+
+# Bumped whenever the layout of the files written by Baker.writemanifest()
+# changes
+MANIFEST_VERSION = 3
+
 if sys.version_info[:2] < (3, 0):  # pragma: no cover
     range = xrange
+    input = raw_input
+    string_types = basestring
+
+    def native(s):
+        """Converts unicode strings decoded from JSON to native strings."""
+        return s.encode("utf-8") if isinstance(s, unicode) else s
+else:
+    string_types = str
+
+    def native(s):
+        return s
+
+
+class Cmd(namedtuple("Cmd", ["name", "fn", "argnames", "keywords",
+                             "shortopts", "has_varargs", "has_kwargs",
+                             "docstring", "varargs_name", "paramdocs",
+                             "is_method", "parser", "files", "options"])):
+    """
+    Stores metadata about a command. 'files' maps the names of file
+    parameters to "r" or "w", and 'options' holds the settings that change
+    how Baker.apply() calls the function.
+
+    If the command was registered without explicit parameter docs, the
+    paramdocs field is None and the ":param" blocks are extracted from the
+    docstring the first time either attribute is accessed. Only help output
+    needs them, so this keeps registering a command cheap.
+    """
+
+    def _docs(self):
+        try:
+            return self._doccache
+        except AttributeError:
+            docstring = super(Cmd, self).docstring
+            paramdocs = super(Cmd, self).paramdocs
+            if paramdocs is None:
+                paramdocs = find_param_docs(docstring)
+                docstring = remove_param_docs(docstring)
+            self._doccache = (docstring, paramdocs)
+            return self._doccache
+
+    @property
+    def docstring(self):
+        return self._docs()[0]
+
+    @property
+    def paramdocs(self):
+        return self._docs()[1]
+
+
+# The outcome of one call made by Baker.run_many(): the item it was made for,
+# the return value or the exception it raised, and the time it took
+Result = namedtuple("Result", ["item", "value", "exception", "elapsed"])
+
+
+class MapResults(object):
+    """
+    The return value of a command registered with map_varargs: an iterator
+    of Result objects, one for each item of the ``*varargs``, in order.
+    """
+    def __init__(self, results):
+        self.results = results
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.results)
+
+    next = __next__
+
+    def close(self):
+        self.results.close()
 
 
-# Stores metadata about a command
-Cmd = namedtuple("Cmd", ["name", "fn", "argnames", "keywords", "shortopts",
-                         "has_varargs", "has_kwargs", "docstring",
-                         "varargs_name", "paramdocs", "is_method"])
+# Lookup tables compiled from the signature of a command when it is
+# registered, so that Baker.parse_args() doesn't have to rebuild them on every
+# invocation
+ParseTable = namedtuple("ParseTable", ["shortchars", "converters", "flags",
+                                       "slots", "has_shortopts"])
 
 PARAM_RE = re.compile(r"^([\t ]*):param (.*?): (.*\n(\1[ \t]+.*\n*)*)",
                       re.MULTILINE)
@@ -93,66 +222,1361 @@ def process_docstring(docstring):
     return paras
 
 
-def format_paras(paras, width, indent=0, lstripline=None):
+def format_paras(paras, width, indent=0, lstripline=None):
+    """
+    Takes a list of paragraph strings and formats them into a word-wrapped,
+    optionally indented string.
+    """
+    output = []
+    for para in paras:
+        lines = wrap(para, width - indent)
+        if lines:
+            for line in lines:
+                output.append((" " * indent) + line)
+    for i in (lstripline or []):
+        output[i] = output[i].lstrip()
+    return output
+
+
+def identity(v):
+    """
+    Returns the value unchanged.
+    """
+    return v
+
+
+def tobool(v):
+    """
+    Converts a string such as "yes" or "off" into a boolean.
+    """
+    lv = v.lower()
+    if lv in ("true", "yes", "on", "1"):
+        return True
+    elif lv in ("false", "no", "off", "0"):
+        return False
+    raise TypeError
+
+
+def converter(default):
+    """
+    Returns the function used to convert a command line string into the same
+    type as 'default'.
+    """
+    if isinstance(default, bool):
+        return tobool
+    elif isinstance(default, int):
+        return int
+    elif isinstance(default, float):
+        return float
+    return identity
+
+
+def compile_parser(argnames, keywords, shortopts, has_kwargs):
+    """
+    Builds the ParseTable used by Baker.parse_args() to parse the arguments
+    of a command with the given signature.
+    """
+    # shortopts maps long option names to characters. To look up short
+    # options, we need the reverse mapping.
+    shortchars = dict((v, k) for k, v in shortopts.items())
+    converters = dict((k, converter(v)) for k, v in keywords.items())
+    # Boolean options don't take a value: specifying them on the command line
+    # means "do the opposite of the default".
+    flags = dict((k, not v) for k, v in keywords.items()
+                 if isinstance(v, bool))
+    # The order in which arguments are passed to the function, and whether
+    # each of them is a keyword argument
+    slots = tuple((name, name in keywords) for name in argnames)
+    return ParseTable(shortchars, converters, flags, slots,
+                      bool(shortopts or has_kwargs))
+
+
+def totype(v, default):
+    """
+    Tries to convert the value 'v' into the same type as 'default'.
+
+        >>> totype('24', 0)
+        24
+        >>> totype('True', False)
+        True
+        >>> totype('0', False)
+        False
+        >>> totype('1', [])
+        '1'
+        >>> totype('none', True)  #doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        TypeError
+    """
+    return converter(default)(v)
+
+
+def iscoroutine(value):
+    """
+    Returns True if the value is a coroutine object, i.e. it was returned
+    by an ``async def`` function.
+    """
+    check = getattr(inspect, "iscoroutine", None)
+    return check is not None and check(value)
+
+
+def isasyncgen(value):
+    """
+    Returns True if the value is an asynchronous generator.
+    """
+    check = getattr(inspect, "isasyncgen", None)
+    return check is not None and check(value)
+
+
+# asyncio, concurrent.futures and the modules used by the command server
+# take longer to import than the rest of Baker together, so they are only
+# imported by the code that needs them.
+
+
+def importfutures(feature):
+    """
+    Imports and returns the concurrent.futures module, which is part of
+    Python 3.2+ and available as the "futures" package on Python 2.
+    """
+    try:
+        from concurrent import futures
+    except ImportError:  # pragma: no cover
+        raise ImportError("%s requires concurrent.futures" % feature)
+    return futures
+
+
+def runloop(awaitable):
+    """
+    Runs the awaitable to completion on a new event loop and returns its
+    result.
+    """
+    import asyncio
+    if hasattr(asyncio, "run"):
+        return asyncio.run(awaitable)
+    loop = asyncio.new_event_loop()  # pragma: no cover
+    try:
+        return loop.run_until_complete(awaitable)
+    finally:
+        loop.close()
+
+
+class AsyncIterator(object):
+    """
+    Iterates over an asynchronous generator from synchronous code, running
+    it on an event loop of its own.
+    """
+    def __init__(self, agen):
+        import asyncio
+        self.agen = agen
+        self.loop = asyncio.new_event_loop()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.loop.is_closed():
+            raise StopIteration
+        try:
+            return self.loop.run_until_complete(self.agen.__anext__())
+        except StopAsyncIteration:
+            self.close()
+            raise StopIteration
+
+    next = __next__
+
+    def close(self):
+        """
+        Closes the generator, running its cleanup code, and the event loop.
+        """
+        if not self.loop.is_closed():
+            try:
+                self.loop.run_until_complete(self.agen.aclose())
+            finally:
+                self.loop.close()
+
+
+def await_result(value):
+    """
+    Runs a coroutine returned by a command function and returns its result,
+    or wraps an async generator in an AsyncIterator. Other values are
+    returned unchanged.
+    """
+    if iscoroutine(value):
+        return runloop(value)
+    elif isasyncgen(value):
+        return AsyncIterator(value)
+    return value
+
+
+def isiterator(value):
+    """
+    Returns True if the value is an iterator, such as a generator, rather
+    than a collection or a string.
+    """
+    try:
+        return iter(value) is value
+    except TypeError:
+        return False
+
+
+def closefiles(iterator, handles):
+    """
+    Yields the items of the iterator, then closes the files in 'handles'.
+    If iterating raises an exception, or the generator is closed early,
+    output files are discarded.
+    """
+    try:
+        for item in iterator:
+            yield item
+    except BaseException:
+        for handle in handles:
+            handle.discard()
+        raise
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            close()
+        for handle in handles:
+            handle.close()
+
+
+def timedcall(fn, args, kwargs):
+    """
+    Calls the function and returns a tuple of (return value, exception,
+    elapsed seconds), catching any exception the function raises.
+    """
+    start = clock()
+    try:
+        value, exception = await_result(fn(*args, **kwargs)), None
+    except Exception as e:
+        value, exception = None, e
+    return value, exception, clock() - start
+
+
+class DecodedInput(io.BufferedReader):
+    """
+    Buffers the output of a decompressing file object, and closes the
+    compressed file along with it.
+    """
+    def __init__(self, stream, fileobj, buffering, closefile=True):
+        io.BufferedReader.__init__(self, stream, buffering)
+        self.fileobj = fileobj
+        self.closefile = closefile
+
+    def close(self):
+        try:
+            io.BufferedReader.close(self)
+        finally:
+            if self.closefile:
+                self.fileobj.close()
+
+
+class PrefetchReader(io.RawIOBase):
+    """
+    Reads a file in large chunks on a background thread, keeping up to
+    'depth' chunks ready in a queue. When the file is a compressed stream
+    from openinput(), this moves decompression off the thread processing
+    the data, and since zlib, bz2 and lzma release the GIL the two overlap.
+
+    This is a raw stream, so wrap it in io.BufferedReader to read lines::
+
+        fobj = io.BufferedReader(PrefetchReader(openinput(path)))
+
+    which is what ``openinput(path, prefetch=True)`` returns. Closing the
+    reader stops the thread and closes the wrapped file. If the thread is
+    waiting for data from a pipe, closing doesn't wait for it: the thread
+    is abandoned and closes the file once its read returns.
+    """
+    def __init__(self, fileobj, chunksize=BUFFER_SIZE, depth=4):
+        io.RawIOBase.__init__(self)
+        self.fileobj = fileobj
+        self.chunksize = chunksize
+        self.queue = queue.Queue(depth)
+        # The chunk being consumed and the position in it
+        self.chunk = memoryview(b"")
+        self.offset = 0
+        self.eof = False
+        self.stopping = False
+        # Whether the thread has exited, and whether close() left it to
+        # close the file
+        self.lock = threading.Lock()
+        self.finished = False
+        self.abandoned = False
+        self.thread = threading.Thread(target=self._prefetch,
+                                       name="baker-prefetch")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _prefetch(self):
+        # read1() returns what is available instead of waiting for a whole
+        # chunk, which matters when reading from a pipe
+        read = getattr(self.fileobj, "read1", self.fileobj.read)
+        try:
+            while not self.stopping:
+                data = read(self.chunksize)
+                if not self._put(data) or not data:
+                    break
+        except Exception as e:
+            # Raised again in the reading thread
+            self._put(e)
+        finally:
+            with self.lock:
+                self.finished = True
+                if self.abandoned:
+                    self.fileobj.close()
+
+    def _put(self, item):
+        """
+        Queues an item unless the reader is closed first. Returns False if
+        it was closed.
+        """
+        while not self.stopping:
+            try:
+                self.queue.put(item, timeout=0.05)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.offset >= len(self.chunk):
+            if self.eof:
+                return 0
+            data = self.queue.get()
+            if isinstance(data, Exception):
+                self.eof = True
+                raise data
+            if not data:
+                self.eof = True
+                return 0
+            self.chunk = memoryview(data)
+            self.offset = 0
+        n = min(len(b), len(self.chunk) - self.offset)
+        b[:n] = self.chunk[self.offset:self.offset + n]
+        self.offset += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stopping = True
+            self.thread.join(1.0)
+            with self.lock:
+                if self.finished:
+                    self.fileobj.close()
+                else:
+                    # The thread is blocked reading, e.g. from an idle pipe,
+                    # and can't be interrupted. It closes the file when the
+                    # read returns.
+                    self.abandoned = True
+        io.RawIOBase.close(self)
+
+
+# The number of bytes read and written through the files opened by
+# openinput() and openoutput(), for the metrics of Baker.run()
+IO_BYTES = {"read": 0, "written": 0}
+_io_lock = threading.Lock()
+
+
+class CountingFileIO(io.FileIO):
+    """
+    A raw file that adds the number of bytes read and written through it to
+    IO_BYTES.
+    """
+    def _count(self, key, n):
+        if n:
+            with _io_lock:
+                IO_BYTES[key] += n
+
+    def readinto(self, b):
+        n = io.FileIO.readinto(self, b)
+        self._count("read", n)
+        return n
+
+    def read(self, size=-1):
+        data = io.FileIO.read(self, size)
+        self._count("read", len(data or b""))
+        return data
+
+    def readall(self):
+        data = io.FileIO.readall(self)
+        self._count("read", len(data))
+        return data
+
+    def write(self, b):
+        n = io.FileIO.write(self, b)
+        self._count("written", n)
+        return n
+
+
+def sniff(header):
+    """
+    Returns the name of the compression format the given leading bytes of a
+    file belong to, or None.
+    """
+    for magic, kind in MAGIC:
+        if header.startswith(magic):
+            return kind
+    return None
+
+
+class MappedInput(object):
+    """
+    A memory-mapped input file, returned by ``openinput(path, mmap=True)``.
+
+    The ``view`` attribute is a memoryview of the whole file, and iterating
+    over the object yields each line (including its newline) as a slice of
+    that view. Nothing is copied, so scanning a large file doesn't allocate
+    a new bytes object per line. Use ``bytes(line)`` to keep a line, since
+    the views must not be used after the file is closed.
+    """
+    def __init__(self, filein):
+        with io.open(filein, 'rb') as fobj:
+            self.size = os.fstat(fobj.fileno()).st_size
+            if self.size:
+                self.map = mmap.mmap(fobj.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+            else:
+                # Empty files can't be mapped
+                self.map = b""
+        try:
+            self.view = memoryview(self.map)
+        except TypeError:  # pragma: no cover
+            # Python 2 can't make a memoryview of a mmap. Slicing a buffer
+            # copies, but the mapping still avoids reading the whole file.
+            self.view = buffer(self.map)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        find = self.map.find
+        view = self.view
+        size = self.size
+        pos = 0
+        while pos < size:
+            end = find(b"\n", pos) + 1 or size
+            yield view[pos:end]
+            pos = end
+
+    def read(self):
+        """
+        Returns the contents of the file as a bytes object.
+        """
+        return self.map[:]
+
+    def close(self):
+        if hasattr(self.view, "release"):
+            self.view.release()
+        if hasattr(self.map, "close"):
+            try:
+                self.map.close()
+            except BufferError:
+                # Lines are still referenced somewhere. The map is closed
+                # when they are garbage collected.
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def openinput(filein, buffering=BUFFER_SIZE, mmap=False, prefetch=False):
+    """
+    Opens the given input file for reading. The returned file is always in
+    binary mode, including standard input.
+
+    Files compressed with gzip, bz2 or xz (if the lzma module is available)
+    are decompressed transparently. The format is detected from the first
+    bytes of the file rather than its name, so misnamed files and
+    compressed standard input work too.
+
+    :param filein: the name of the file, or "-" for standard input.
+        Standard input is read through a new reader on its file descriptor,
+        which doesn't see data already buffered by sys.stdin, and closing
+        it leaves sys.stdin open.
+    :param buffering: the size of the read buffer in bytes.
+    :param mmap: if True, memory-map the file and return a MappedInput.
+        This only works for uncompressed regular files.
+    :param prefetch: if True, read and decompress the file on a background
+        thread with a PrefetchReader.
+    """
+    if mmap:
+        if filein == '-':
+            raise ValueError("Standard input can't be memory-mapped")
+        mapped = MappedInput(filein)
+        if sniff(mapped.map[:6]) is not None:
+            mapped.close()
+            raise ValueError("Compressed file %r can't be memory-mapped"
+                             % filein)
+        return mapped
+
+    fileobj = _openinput(filein, buffering)
+    if prefetch:
+        return io.BufferedReader(PrefetchReader(fileobj, buffering),
+                                 buffering)
+    return fileobj
+
+
+def _openinput(filein, buffering):
+    """
+    Opens the given file for openinput(), decompressing it if necessary.
+    """
+
+    if filein == '-':
+        try:
+            fd = sys.stdin.fileno()
+        except (AttributeError, ValueError, io.UnsupportedOperation):
+            # Standard input was replaced by an object without a file
+            # descriptor
+            fd = None
+        if fd is not None:
+            # A reader of our own, so closing it leaves sys.stdin open
+            fileobj = io.open(fd, 'rb', buffering, closefd=False)
+        else:
+            fileobj = sys.stdin.buffer
+        closefile = False
+    else:
+        fileobj = io.BufferedReader(CountingFileIO(filein, 'rb'), buffering)
+        closefile = True
+
+    kind = sniff(fileobj.peek(6)[:6])
+    if kind is None:
+        return fileobj
+    try:
+        if kind == "gzip":
+            stream = gzip.GzipFile(fileobj=fileobj, mode="rb")
+        elif kind == "bz2":
+            if sys.version_info[:2] < (3, 3):  # pragma: no cover
+                # BZ2File can't read from a file object before Python 3.3
+                if filein == '-':
+                    raise IOError("Reading bz2 data from standard input "
+                                  "requires Python 3.3")
+                fileobj.close()
+                return bz2.BZ2File(filein, 'rb', buffering)
+            else:
+                stream = bz2.BZ2File(fileobj)
+        else:
+            if lzma is None:  # pragma: no cover
+                raise IOError("Reading xz data requires the lzma module")
+            stream = lzma.LZMAFile(fileobj)
+    except Exception:
+        if closefile:
+            fileobj.close()
+        raise
+    return DecodedInput(stream, fileobj, buffering, closefile)
+
+
+class CompressingWriter(io.RawIOBase):
+    """
+    Compresses everything written to it with a zlib, bz2 or lzma compressor
+    object and writes the result to another file. If the compressor is None
+    the data is written unchanged.
+    """
+    def __init__(self, fileobj, compressor=None, closefile=True):
+        io.RawIOBase.__init__(self)
+        self.fileobj = fileobj
+        self.compressor = compressor
+        self.closefile = closefile
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        data = memoryview(b).tobytes()
+        if self.compressor is None:
+            self.fileobj.write(data)
+        else:
+            self.fileobj.write(self.compressor.compress(data))
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.compressor is not None:
+                self.fileobj.write(self.compressor.flush())
+        finally:
+            try:
+                if self.closefile:
+                    self.fileobj.close()
+                else:
+                    self.fileobj.flush()
+            finally:
+                io.RawIOBase.close(self)
+
+
+class BackgroundWriter(io.RawIOBase):
+    """
+    Passes everything written to it to another file on a background
+    thread, so that compressing and writing the data overlaps with the
+    computation producing it. At most 'depth' writes are kept waiting.
+
+    An error raised by the wrapped file is raised again by the next write
+    or by close(). Closing waits for the pending writes and closes the
+    wrapped file.
+    """
+    def __init__(self, fileobj, depth=4):
+        io.RawIOBase.__init__(self)
+        self.fileobj = fileobj
+        self.queue = queue.Queue(depth)
+        self.error = None
+        self.thread = threading.Thread(target=self._write,
+                                       name="baker-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            if self.error is None:
+                try:
+                    self.fileobj.write(data)
+                except Exception as e:
+                    self.error = e
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self.error is not None:
+            raise self.error
+        data = memoryview(b).tobytes()
+        self.queue.put(data)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        try:
+            self.fileobj.close()
+        finally:
+            io.RawIOBase.close(self)
+        if self.error is not None:
+            raise self.error
+
+
+def createtemp(dirname, prefix):
+    """
+    Creates a new file with a random name in the given directory and
+    returns its descriptor and path. Unlike tempfile.mkstemp(), the file
+    gets the permissions open() would give it, as the kernel applies the
+    umask in force.
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    for _ in range(100):
+        suffix = "".join("%02x" % c for c in bytearray(os.urandom(6)))
+        path = os.path.join(dirname, prefix + suffix)
+        try:
+            return os.open(path, flags, 0o666), path
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    raise IOError(errno.EEXIST, "No unused temporary file name in %r"
+                  % dirname)
+
+# os.rename() doesn't replace an existing file on Windows, and Python 2 has
+# no os.replace()
+_replacefile = getattr(os, "replace", os.rename)
+
+
+class AtomicOutput(io.BufferedWriter):
+    """
+    The buffered file returned by openoutput(). The data is written to a
+    temporary file in the same directory as the output file, which is
+    renamed to the output file's name when closed. Readers never see a
+    partially written file, and an existing file is only replaced when the
+    new one is complete.
+
+    Use discard() to close the file and delete what was written instead.
+    Leaving a ``with`` block because of an exception discards the file, as
+    does garbage collecting it without closing it.
+    """
+    def __init__(self, raw, path, tmppath, buffering=BUFFER_SIZE):
+        io.BufferedWriter.__init__(self, raw, buffering)
+        self.path = path
+        self.tmppath = tmppath
+        self.keep = True
+
+    def discard(self):
+        self.keep = False
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            io.BufferedWriter.close(self)
+        except Exception:
+            self.keep = False
+            raise
+        finally:
+            if self.tmppath is not None:
+                tmppath, self.tmppath = self.tmppath, None
+                if self.keep:
+                    _replacefile(tmppath, self.path)
+                else:
+                    os.unlink(tmppath)
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.keep = False
+        self.close()
+
+    def __del__(self):
+        self.keep = False
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def openoutput(fileout, buffering=BUFFER_SIZE, background=False):
+    """
+    Opens the given output file for writing. The returned file is always in
+    binary mode, including standard output.
+
+    Files ending with .gz, .bz2 or .xz (if the lzma module is available)
+    are compressed with the matching format. The data only appears under
+    the given name when the file is closed; see AtomicOutput.
+
+    :param fileout: the name of the file, or "-" for standard output.
+    :param buffering: the size of the write buffer in bytes.
+    :param background: if True, compress and write the data on a background
+        thread with a BackgroundWriter.
+    """
+    if fileout == '-':
+        # Anything already printed goes first
+        sys.stdout.flush()
+        stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+        raw = CompressingWriter(stdout, closefile=False)
+        tmppath = None
+    else:
+        ext = os.path.splitext(fileout)[1].lower()
+        if ext == ".gz":
+            # gzip's default level 9 is several times slower than the
+            # zlib default for a few percent smaller files
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+        elif ext == ".bz2":
+            compressor = bz2.BZ2Compressor()
+        elif ext == ".xz":
+            if lzma is None:  # pragma: no cover
+                raise IOError("Writing xz data requires the lzma module")
+            compressor = lzma.LZMACompressor()
+        else:
+            compressor = None
+
+        dirname, basename = os.path.split(os.path.abspath(fileout))
+        fd, tmppath = createtemp(dirname, ".%s." % basename)
+        raw = CountingFileIO(fd, "wb")
+        if compressor is not None:
+            raw = CompressingWriter(raw, compressor)
+
+    if background:
+        raw = BackgroundWriter(raw)
+    return AtomicOutput(raw, fileout, tmppath, buffering)
+
+
+class LazyFile(object):
+    """
+    The value Baker.apply() passes for a file parameter. It is opened with
+    openinput() or openoutput() when it is first used and otherwise behaves
+    like the opened file, so a command that never touches a file never
+    opens it.
+
+    Iterating over an input file to the end closes it, so a command going
+    through many files in turn only has one of them open at a time.
+    """
+    def __init__(self, name, mode="r", prefetch=False):
+        self.name = name
+        self.mode = mode
+        self.prefetch = prefetch
+        self.fileobj = None
+        self.closed = False
+
+    def open(self):
+        """
+        Opens the file if necessary and returns the file object.
+        """
+        if self.fileobj is None:
+            if self.closed:
+                raise ValueError("I/O operation on closed file %r"
+                                 % self.name)
+            if self.mode == "w":
+                self.fileobj = openoutput(self.name)
+            else:
+                self.fileobj = openinput(self.name, prefetch=self.prefetch)
+        return self.fileobj
+
+    def __getattr__(self, attr):
+        return getattr(self.open(), attr)
+
+    def __iter__(self):
+        fileobj = self.open()
+        for line in fileobj:
+            yield line
+        if self.mode == "r":
+            self.close()
+
+    def close(self):
+        """
+        Closes the file if it was opened.
+        """
+        self.closed = True
+        fileobj, self.fileobj = self.fileobj, None
+        if fileobj is not None:
+            fileobj.close()
+
+    def discard(self):
+        """
+        Closes the file, deleting it instead of saving it if it's an output
+        file.
+        """
+        if self.mode == "w" and self.fileobj is not None:
+            self.closed = True
+            fileobj, self.fileobj = self.fileobj, None
+            fileobj.discard()
+        else:
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.discard()
+        else:
+            self.close()
+
+    def __repr__(self):
+        return "<LazyFile %r mode %r>" % (self.name, self.mode)
+
+
+class FilePool(object):
+    """
+    Lets a command read from more files at once than it can keep open,
+    e.g. to merge thousands of sorted shards::
+
+        pool = FilePool(256)
+        shards = [pool.open(name) for name in names]
+
+    At most 'maxopen' of the files are open at any time. When another file
+    has to be opened, the least recently used one is closed and its offset
+    saved, and it is reopened and seeked back the next time it is used.
+    Seeking in a compressed file decompresses it from the start again, so
+    keep 'maxopen' above the number of files that are read in turn.
+
+    'hits' counts the reads from files that were already open and 'reopens'
+    the times a closed file was opened again.
+    """
+    def __init__(self, maxopen=256, opener=openinput):
+        if maxopen < 1:
+            raise ValueError("maxopen must be at least 1")
+        self.maxopen = maxopen
+        self.opener = opener
+        # Maps PooledFile objects to open files, least recently used first
+        self.lru = OrderedDict()
+        self.hits = 0
+        self.reopens = 0
+
+    def open(self, name):
+        """
+        Returns a PooledFile for the given file name. The file itself is
+        opened when it is first read.
+        """
+        return PooledFile(self, name)
+
+    def acquire(self, pooled):
+        """
+        Returns the open file object of the given PooledFile, opening it if
+        necessary.
+        """
+        fileobj = self.lru.pop(pooled, None)
+        if fileobj is not None:
+            self.hits += 1
+        else:
+            if pooled.closed:
+                raise ValueError("I/O operation on closed file %r"
+                                 % pooled.name)
+            while len(self.lru) >= self.maxopen:
+                old, oldobj = self.lru.popitem(last=False)
+                old.offset = oldobj.tell()
+                oldobj.close()
+            fileobj = self.opener(pooled.name)
+            if pooled.offset is None:
+                pooled.offset = 0
+            else:
+                self.reopens += 1
+                if pooled.offset:
+                    fileobj.seek(pooled.offset)
+        self.lru[pooled] = fileobj
+        return fileobj
+
+    def release(self, pooled):
+        """
+        Closes the open file object of the given PooledFile, if any.
+        """
+        fileobj = self.lru.pop(pooled, None)
+        if fileobj is not None:
+            fileobj.close()
+
+    def close(self):
+        """
+        Closes all the files of the pool.
+        """
+        for pooled in list(self.lru):
+            pooled.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PooledFile(object):
+    """
+    A file opened through a FilePool. It supports reading, seeking and
+    iterating over lines, and is opened again by the pool whenever
+    necessary. Iterating over the file to the end closes it.
+    """
+    def __init__(self, pool, name):
+        self.pool = pool
+        self.name = name
+        # The offset to seek to when reopening, or None if never opened
+        self.offset = None
+        self.closed = False
+
+    def read(self, size=-1):
+        return self.pool.acquire(self).read(size)
+
+    def readline(self, size=-1):
+        return self.pool.acquire(self).readline(size)
+
+    def readlines(self):
+        return self.pool.acquire(self).readlines()
+
+    def seek(self, offset, whence=0):
+        return self.pool.acquire(self).seek(offset, whence)
+
+    def tell(self):
+        return self.pool.acquire(self).tell()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            self.close()
+            raise StopIteration
+        return line
+
+    next = __next__
+
+    def close(self):
+        self.closed = True
+        self.pool.release(self)
+
+    # Input files have nothing to throw away
+    discard = close
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        return "<PooledFile %r>" % self.name
+
+
+class InputChunk(object):
+    """
+    The part of a large input file passed to a command with split_input.
+    Iterating over it yields the lines of the part, which is either the
+    range of bytes [start, end) of the file called 'name', or the bytes in
+    'data' for parts of compressed files and standard input.
+    """
+    def __init__(self, name, start=0, end=0, data=None):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.data = data
+
+    def __iter__(self):
+        if self.data is not None:
+            return iter(io.BytesIO(self.data))
+        return self._lines()
+
+    def _lines(self):
+        remaining = self.end - self.start
+        if remaining <= 0:
+            return
+        with io.open(self.name, "rb", BUFFER_SIZE) as fobj:
+            fobj.seek(self.start)
+            for line in fobj:
+                yield line
+                remaining -= len(line)
+                if remaining <= 0:
+                    break
+
+
+def linechunks(filein, parts):
+    """
+    Splits the given uncompressed file into about 'parts' ranges of bytes
+    that start and end on line boundaries. Returns a list of (start, end)
+    tuples.
+    """
+    size = os.path.getsize(filein)
+    bounds = [0]
+    with io.open(filein, "rb") as fobj:
+        for i in range(1, parts):
+            pos = size * i // parts
+            if pos <= bounds[-1]:
+                continue
+            # Move to the start of the next line, unless pos is already at
+            # the start of a line
+            fobj.seek(pos - 1)
+            fobj.readline()
+            pos = fobj.tell()
+            if pos >= size:
+                break
+            if pos > bounds[-1]:
+                bounds.append(pos)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def lineblocks(fobj, blocksize):
+    """
+    Reads the file in blocks of about 'blocksize' bytes that end on line
+    boundaries. Always yields at least one, possibly empty, block.
+    """
+    data = fobj.read(blocksize)
+    while True:
+        yield data + fobj.readline()
+        data = fobj.read(blocksize)
+        if not data:
+            break
+
+
+def maxrss():
+    """
+    Returns the maximum resident set size of this process so far in bytes,
+    or None if the resource module isn't available.
+    """
+    try:
+        import resource
+    except ImportError:  # pragma: no cover
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def formatmemory(report):
+    """
+    Formats the report of Baker.memory() for people.
+    """
+    def mib(size):
+        if size is None:
+            return "unknown"
+        return "%.1f MiB" % (size / 1048576.0)
+
+    lines = ["Memory used by %r:" % report["command"],
+             "  Peak allocated by Python: %s" % mib(report["peak"]),
+             "  Maximum resident set size: %s (%s before the command)"
+             % (mib(report["maxrss_after"]), mib(report["maxrss_before"]))]
+    if report["lines"]:
+        lines.append("  Largest allocations still held at the end:")
+    for entry in report["lines"]:
+        lines.append("    %10s in %6d blocks  %s:%d"
+                     % (mib(entry["size"]), entry["count"], entry["file"],
+                        entry["line"]))
+    return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def locked(fobj):
+    """
+    Holds an exclusive lock on the open file during the with statement, on
+    systems with fcntl.
+    """
+    try:
+        import fcntl
+    except ImportError:  # pragma: no cover
+        yield
+        return
+    fcntl.flock(fobj.fileno(), fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(fobj.fileno(), fcntl.LOCK_UN)
+
+
+def writejsonl(path, records):
+    """
+    Appends the records to the file as lines of JSON. The lines are written
+    with a single call under a lock, so concurrent processes don't mix up
+    their lines.
+    """
+    lines = "".join(json.dumps(record, sort_keys=True) + "\n"
+                    for record in records)
+    with open(path, "a") as fobj:
+        with locked(fobj):
+            fobj.write(lines)
+            fobj.flush()
+
+
+# The metrics kept in the Prometheus files written by Baker.metering(), with
+# their types and help
+PROMETHEUS_METRICS = (
+    ("baker_runs_total", "counter", "Runs by command and status."),
+    ("baker_run_seconds_total", "counter", "Time spent running commands."),
+    ("baker_bytes_read_total", "counter",
+     "Bytes read from files opened by openinput()."),
+    ("baker_bytes_written_total", "counter",
+     "Bytes written to files opened by openoutput()."),
+    ("baker_last_exit_code", "gauge", "Exit code of the last run."),
+    ("baker_last_run_timestamp_seconds", "gauge",
+     "Time the last run started."),
+)
+
+PROMETHEUS_RE = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})? (\S+)$")
+
+
+def writeprometheus(path, records):
+    """
+    Adds the records to the metrics in a Prometheus textfile. The file is
+    read and rewritten under a lock on a separate lock file, so concurrent
+    runs don't lose each other's counts, and replaced with a rename, so the
+    collector never reads a partial file.
+    """
+    updates = []
+    for record in records:
+        command = (record["command"] or "").replace("\\", "\\\\")
+        command = command.replace('"', '\\"').replace("\n", "\\n")
+        labels = '{command="%s"}' % command
+        updates.extend([
+            ("baker_runs_total", '{command="%s",status="%s"}'
+             % (command, record["status"]), 1, True),
+            ("baker_run_seconds_total", labels, record["seconds"], True),
+            ("baker_bytes_read_total", labels, record["bytes_read"], True),
+            ("baker_bytes_written_total", labels, record["bytes_written"],
+             True),
+            ("baker_last_exit_code", labels, record["exit_code"], False),
+            ("baker_last_run_timestamp_seconds", labels, record["time"],
+             False),
+        ])
+
+    with open(path + ".lock", "a") as lockfile:
+        with locked(lockfile):
+            # Maps (name, labels) to values
+            values = {}
+            try:
+                with open(path) as fobj:
+                    for line in fobj:
+                        match = PROMETHEUS_RE.match(line.strip())
+                        if match:
+                            values[match.group(1), match.group(2) or ""] = \
+                                float(match.group(3))
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            for name, labelstr, value, add in updates:
+                if add:
+                    value += values.get((name, labelstr), 0)
+                values[name, labelstr] = value
+
+            lines = []
+            for name, kind, text in PROMETHEUS_METRICS:
+                lines.append("# HELP %s %s\n# TYPE %s %s\n"
+                             % (name, text, name, kind))
+                for (vname, labelstr), value in sorted(values.items()):
+                    if vname == name:
+                        lines.append("%s%s %s\n"
+                                     % (name, labelstr, repr(float(value))))
+
+            import tempfile
+            dirname = os.path.dirname(os.path.abspath(path))
+            fd, tmppath = tempfile.mkstemp(dir=dirname, prefix=".baker")
+            try:
+                with os.fdopen(fd, "w") as fobj:
+                    fobj.write("".join(lines))
+                os.chmod(tmppath, 0o644)
+                _replacefile(tmppath, path)
+            except Exception:
+                os.unlink(tmppath)
+                raise
+
+
+class StackSampler(object):
+    """
+    A sampling profiler with a low enough overhead to leave on for long
+    runs. A background thread records the stacks of all the other threads
+    'hz' times per second, and collapsed() returns the number of times each
+    stack was seen in the format of flamegraph.pl and similar tools. The
+    root of each stack is the name of its thread, so the time spent in
+    e.g. the "baker-map" or "baker-prefetch" threads is shown separately.
+    """
+    def __init__(self, hz=100):
+        self.interval = 1.0 / hz
+        # Maps "thread;outer;...;inner" stacks to the number of samples
+        self.counts = {}
+        # Frame labels, keyed by code object
+        self.labels = {}
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run,
+                                       name="baker-sampler")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            self.sample()
+
+    def label(self, code):
+        try:
+            return self.labels[code]
+        except KeyError:
+            label = "%s (%s:%d)" % (code.co_name, code.co_filename,
+                                    code.co_firstlineno)
+            self.labels[code] = label
+            return label
+
+    def sample(self):
+        """
+        Records the current stack of every thread except the sampler's.
+        """
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            if ident == self.thread.ident:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self.label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, "thread-%d" % ident))
+            key = ";".join(reversed(stack))
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def collapsed(self):
+        """
+        Returns the samples as "stack count" lines.
+        """
+        return "".join("%s %d\n" % (stack, count)
+                       for stack, count in sorted(self.counts.items()))
+
+
+class LazyFunction(object):
+    """
+    Stands in for a function given by a "package.module:function" path. The
+    module is only imported when the function is loaded or called.
+    """
+    def __init__(self, target, source=None):
+        self.target = target
+        # The file the function is defined in, if known
+        self.source = source
+        self.__name__ = target.rpartition(":")[2].rpartition(".")[2]
+
+    def load(self):
+        """
+        Imports the module and returns the function object.
+        """
+        modname, _, attrs = self.target.partition(":")
+        __import__(modname)
+        obj = sys.modules[modname]
+        for attr in attrs.split("."):
+            obj = getattr(obj, attr)
+        return obj
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+
+# Messages between the command server and its clients are framed as a
+# one-byte kind and a four-byte payload length
+FRAME = "!cI"
+
+
+def sendframe(sock, kind, payload):
     """
-    Takes a list of paragraph strings and formats them into a word-wrapped,
-    optionally indented string.
+    Sends one message to a command server or client.
     """
-    output = []
-    for para in paras:
-        lines = wrap(para, width - indent)
-        if lines:
-            for line in lines:
-                output.append((" " * indent) + line)
-    for i in (lstripline or []):
-        output[i] = output[i].lstrip()
-    return output
+    import struct
+    sock.sendall(struct.pack(FRAME, kind, len(payload)) + payload)
 
 
-def totype(v, default):
+def recvframe(sock):
     """
-    Tries to convert the value 'v' into the same type as 'default'.
+    Receives one message sent with sendframe(). Returns a tuple of
+    (kind, payload), or (None, None) if the connection was closed.
+    """
+    import struct
+    header = recvall(sock, struct.calcsize(FRAME))
+    if header is None:
+        return None, None
+    kind, size = struct.unpack(FRAME, header)
+    return kind, recvall(sock, size)
 
-        >>> totype('24', 0)
-        24
-        >>> totype('True', False)
-        True
-        >>> totype('0', False)
-        False
-        >>> totype('1', [])
-        '1'
-        >>> totype('none', True)  #doctest: +ELLIPSIS
-        Traceback (most recent call last):
-        ...
-        TypeError
+
+def recvall(sock, size):
     """
-    if isinstance(default, bool):
-        lv = v.lower()
-        if lv in ("true", "yes", "on", "1"):
-            return True
-        elif lv in ("false", "no", "off", "0"):
-            return False
-        raise TypeError
-    elif isinstance(default, int):
-        return int(v)
-    elif isinstance(default, float):
-        return float(v)
-    return v
+    Reads exactly 'size' bytes from the socket, or returns None if the
+    connection is closed first.
+    """
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 16))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
 
 
-def openinput(filein):
+class FrameWriter(object):
     """
-    Opens the given input file. It can decode various formats too, such as
-    gzip and bz2.
+    A file-like object that sends everything written to it to a command
+    server client, which copies it to its own stdout or stderr.
     """
-    if filein == '-':
-        return sys.stdin
-    ext = os.path.splitext(filein)[1]
-    if ext in ['.gz', '.GZ']:
-        return gzip.open(filein, 'rb')
-    if ext in ['.bz', '.bz2']:
-        return bz2.BZ2File(filein, 'rb')
-    return open(filein, 'rb')
+    encoding = "utf-8"
+
+    def __init__(self, sock, kind):
+        self.sock = sock
+        self.kind = kind
+
+    def write(self, content):
+        if not isinstance(content, bytes):
+            content = content.encode("utf-8")
+        if content:
+            sendframe(self.sock, self.kind, content)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
 
 
 class CommandError(Exception):
@@ -195,11 +1619,34 @@ class Baker(object):
     format them accordingly.
     """
 
-    def __init__(self, global_options=None):
+    def __init__(self, global_options=None, metrics=None):
+        """
+        :param global_options: the initial values of the global options.
+        :param metrics: a file to record every run() and every line of
+            run_batch() in. If the name ends
+            with ".prom", the file holds Prometheus metrics for the
+            node_exporter textfile collector, which are updated on each run.
+            Otherwise a line of JSON is appended for each run.
+        """
+        self.metrics = metrics
         self.commands = {}
         self.defaultcommand = None
         self.globalcommand = None
         self.global_options = global_options or {}
+        # Rendered help text, keyed by (scriptname, command name). Cleared
+        # whenever a command is registered.
+        self._helpcache = {}
+        # The RESERVED_OPTIONS found by the last call to parse(), without the
+        # leading dashes, mapped to their values or True
+        self.reserved = {}
+        # The number of entries printed by --baker-profile
+        self.profile_limit = 30
+        # The number of source lines reported by --baker-mem
+        self.mem_limit = 10
+        # Callbacks registered with on(), keyed by event
+        self.hooks = dict((event, []) for event in HOOK_EVENTS)
+        # The seconds spent in each phase of the last command line
+        self.timings = {}
 
     def get(self, key, default=None):
         """Shortcut for ``self.global_options.get()``.
@@ -221,7 +1668,10 @@ class Baker(object):
         return self.global_options.get(key, default)
 
     def command(self, fn=None, name=None, default=False,
-                params=None, shortopts=None, global_command=False):
+                params=None, shortopts=None, global_command=False,
+                files=None, prefetch=False, maxopen=None, split_input=None,
+                reducer=None, workers=None, map_varargs=False,
+                executor="thread"):
         """
         Registers a command with the bakery. This does not call the
         function, it simply adds it to the list of functions this Baker
@@ -246,6 +1696,40 @@ class Baker(object):
             Sphinx-style ':param' blocks.
         :param shortopts: a dictionary mapping parameter names to short
             options, e.g. {"verbose": "v"}.
+        :param files: a dictionary mapping parameter names to "r" for input
+            files or "w" for output files, e.g. {"src": "r", "dst": "w"}.
+            The function is passed a LazyFile for each file name instead of
+            the string, and the files are closed when it returns. If the
+            function raises an exception, output files are discarded. Each
+            item of a ``*varargs`` parameter becomes a separate LazyFile.
+        :param prefetch: if True, input files are read on a background
+            thread; see PrefetchReader.
+        :param maxopen: if given, the items of a ``*varargs`` input file
+            parameter are opened through a FilePool that keeps at most this
+            many of them open.
+        :param split_input: the name of a parameter taking a large input
+            file. The file is split into parts ending on line boundaries,
+            and the function is called for each part in a pool of
+            'workers' processes, with an iterator over the lines of the part
+            (an InputChunk) in place of the file name. The function and its
+            arguments must be picklable. Compressed files and standard input
+            are decompressed by the main process and sent to the workers in
+            blocks. It can't be combined with 'files'.
+        :param reducer: a function of two arguments used to combine the
+            return values of the parts, as with reduce(). Without it, the
+            command returns the list of values.
+        :param workers: the number of processes used by split_input,
+            defaults to the number of CPUs, or the number of threads or
+            processes used by map_varargs.
+        :param map_varargs: if True, the function is called once for each
+            item of its ``*varargs`` in a pool of 'workers' threads or
+            processes, with the item as its only varargs argument. The
+            command returns a MapResults iterator instead of a value. run()
+            prints the values as they are ready, in order, reports the items
+            that failed and exits with an error code if there were any.
+        :param executor: "thread" or "process", the kind of pool used by
+            map_varargs. With "process", the function, its arguments and
+            return values must be picklable.
         """
         # This method works as a decorator with or without arguments.
         if fn is None:
@@ -256,8 +1740,15 @@ class Baker(object):
                                            name=name,
                                            params=params,
                                            shortopts=shortopts,
-                                           global_command=global_command)
+                                           global_command=global_command,
+                                           files=files, prefetch=prefetch,
+                                           maxopen=maxopen,
+                                           split_input=split_input,
+                                           reducer=reducer, workers=workers,
+                                           map_varargs=map_varargs,
+                                           executor=executor)
         else:
+            self._helpcache.clear()
             name = name or fn.__name__
 
             # Inspect the argument signature of the function
@@ -270,14 +1761,12 @@ class Baker(object):
             docstring = fn.__doc__ or ""
 
             # If the user didn't specify parameter help in the decorator
-            # arguments, try to get it from parameter annotations (Python 3.x)
-            # or RST-style :param: lines in the docstring
+            # arguments, try to get it from parameter annotations (Python 3.x).
+            # Otherwise leave params as None, and the Cmd will look for
+            # RST-style :param: lines in the docstring when they're needed.
             if params is None:
                 if hasattr(fn, "func_annotations") and fn.func_annotations:  # pragma: no cover
                     params = fn.func_annotations
-                else:
-                    params = find_param_docs(docstring)
-                    docstring = remove_param_docs(docstring)
 
             # If the user didn't specify
             shortopts = shortopts or {}
@@ -296,9 +1785,43 @@ class Baker(object):
                 is_method = True
                 arglist.pop(0)
 
+            files = files or {}
+            for argname, mode in files.items():
+                if argname not in arglist and argname != varargs_name:
+                    raise CommandError("%r has no parameter %r"
+                                       % (name, argname), None)
+                if mode not in ("r", "w"):
+                    raise CommandError("File mode of %r must be 'r' or 'w', "
+                                       "not %r" % (argname, mode), None)
+            if split_input is not None:
+                if split_input not in arglist:
+                    raise CommandError("%r has no parameter %r"
+                                       % (name, split_input), None)
+                if files:
+                    # The parts are processed in other processes, which
+                    # couldn't use files opened by this one
+                    raise CommandError("split_input can't be combined with "
+                                       "files", None)
+            if map_varargs:
+                if not has_varargs:
+                    raise CommandError("map_varargs requires a *varargs "
+                                       "parameter", None)
+                if files or split_input is not None:
+                    raise CommandError("map_varargs can't be combined with "
+                                       "files or split_input", None)
+                if executor not in ("thread", "process"):
+                    raise CommandError("executor must be 'thread' or "
+                                       "'process', not %r" % executor, None)
+            options = {"prefetch": prefetch, "maxopen": maxopen,
+                       "split_input": split_input, "reducer": reducer,
+                       "workers": workers, "map_varargs": map_varargs,
+                       "executor": executor}
+
             # Create a Cmd object to represent this command and store it
+            parser = compile_parser(arglist, keywords, shortopts, has_kwargs)
             cmd = Cmd(name, fn, arglist, keywords, shortopts, has_varargs,
-                      has_kwargs, docstring, varargs_name, params, is_method)
+                      has_kwargs, docstring, varargs_name, params, is_method,
+                      parser, files, options)
             # If global_command is True, set this as the global command
             if global_command:
                 if defaults is not None and len(defaults) != len(arglist):
@@ -321,6 +1844,108 @@ class Baker(object):
 
             return fn
 
+    def lazycommand(self, target, name=None, summary=""):
+        """
+        Registers a command by the import path of its function, without
+        importing it. The module is imported when the command is run or its
+        detailed help is requested::
+
+            b.lazycommand("myapp.models:train", "train", "Trains the model.")
+
+        If importing the module registers the function itself (e.g. because
+        it's decorated with this Baker's ``command``), that registration is
+        used, under the name given here. Otherwise the function is registered with the
+        default options.
+
+        :param target: the function to run, as "package.module:function".
+        :param name: the name of the command, defaults to the function name.
+        :param summary: the one-line description shown in the list of
+            commands.
+        """
+        self._helpcache.clear()
+        fn = LazyFunction(target)
+        name = name or fn.__name__
+        # The signature is unknown until the module is imported, which is
+        # marked by argnames being None
+        self.commands[name] = Cmd(name, fn, None, {}, {}, False, False,
+                                  summary, None, {}, False, None, {}, {})
+
+    def on(self, event, callback=None):
+        """
+        Registers a function to call after a phase of running a command
+        line. It is called with the Cmd object, the positional and keyword
+        arguments parsed from the command line (None for after_import), and
+        the 'timings' dictionary, which maps the phases done so far to the
+        seconds they took::
+
+            @b.on("after_output")
+            def report(cmd, args, kwargs, timings):
+                histogram(cmd.name).add(sum(timings.values()))
+
+        This method works as a decorator with or without a callback.
+
+        :param event: one of "after_import" (a lazy command was imported,
+            phase "import"), "after_parse" ("parse"), "after_global_apply"
+            (the global command was called, "global_apply"), "after_apply"
+            (the command was called, "apply") and "after_output" (its
+            return value was written by run(), "output").
+        :param callback: the function to call.
+        """
+        if event not in self.hooks:
+            raise ValueError("Unknown event %r" % event)
+        if callback is None:
+            return lambda callback: self.on(event, callback)
+        self.hooks[event].append(callback)
+        return callback
+
+    def fire(self, event, cmd, args=None, kwargs=None):
+        """
+        Calls the callbacks registered for the event.
+        """
+        for callback in self.hooks[event]:
+            callback(cmd, args, kwargs, self.timings)
+
+    def load(self, cmd):
+        """
+        Returns the function of the command, importing it if it's a
+        LazyFunction. The time it takes counts as the "import" phase.
+        """
+        if not isinstance(cmd.fn, LazyFunction):
+            return cmd.fn
+        started = clock()
+        fn = cmd.fn.load()
+        self.timings["import"] = (self.timings.get("import", 0)
+                                  + clock() - started)
+        self.fire("after_import", cmd)
+        return fn
+
+    def resolve(self, cmd):
+        """
+        Returns the complete Cmd object for the given command, importing the
+        module of a command registered with lazycommand() if necessary.
+        """
+        if cmd.argnames is not None:
+            return cmd
+        fn = self.load(cmd)
+        # Importing the module may have registered the function itself,
+        # possibly under another name. That registration is moved to the
+        # name given to lazycommand(), so the command isn't listed twice.
+        for registered in list(self.commands.values()):
+            if registered.fn is fn and registered.argnames is not None:
+                break
+        else:
+            self.command(fn, name=cmd.name)
+            return self.commands[cmd.name]
+        if registered.name != cmd.name:
+            del self.commands[registered.name]
+            renamed = registered._replace(name=cmd.name)
+            self.commands[cmd.name] = renamed
+            if self.defaultcommand is registered:
+                self.defaultcommand = renamed
+            self._helpcache.clear()
+            registered = renamed
+        return registered
+
     def usage(self, cmd=None, scriptname=None,
               exception=None, fobj=sys.stdout):
         """
@@ -336,7 +1961,7 @@ class Baker(object):
             self.print_top_help(scriptname, fobj=fobj)
         else:
             if isinstance(cmd, str):
-                cmd = self.commands[cmd]
+                cmd = self.resolve(self.commands[cmd])
 
             self.print_command_help(scriptname, cmd, fobj=fobj)
 
@@ -349,7 +1974,8 @@ class Baker(object):
                             '{scriptname}.ini'.
         """
         ret = []
-        for cmdname, cmd in self.commands.items():
+        for cmdname, cmd in list(self.commands.items()):
+            cmd = self.resolve(cmd)
             ret.append("[%s]" % (cmdname))
             for line in self.return_cmd_doc(cmd):
                 ret.append(("# " + line).rstrip())
@@ -363,6 +1989,171 @@ class Baker(object):
         with open(iniconffile, 'w+') as fp:
             self.write(fp, "\n".join(ret), False)
 
+    def writemanifest(self, path, sources=()):
+        """
+        Saves a manifest of all the registered commands to the given file,
+        so that a later run can use readmanifest() to dispatch commands and
+        print help without importing the modules that define them.
+
+        The manifest is only valid while the source files of the commands
+        are unchanged. If the script itself decides which commands exist
+        (e.g. by calling lazycommand()), pass its path in 'sources' too.
+
+        The manifest is a JSON file. Raises ValueError if a command or its
+        reducer can't be imported by name, e.g. a method or a lambda, or if
+        the repr() of one of its default values isn't a Python literal.
+
+        :param path: the file name of the manifest.
+        :param sources: extra files the manifest depends on.
+        """
+        import ast
+        entries = []
+        files = set(sources)
+        for cmd in list(self.commands.values()) + [self.globalcommand]:
+            if cmd is None:
+                continue
+            cmd = self.resolve(cmd)
+            if cmd.is_method:
+                raise ValueError("Command %r can't be imported by name"
+                                 % cmd.name)
+            target, source = self._importpath(cmd.fn, "Command %r" % cmd.name)
+            if source:
+                files.add(os.path.abspath(source))
+            options = dict(cmd.options)
+            if options.get("reducer") is not None:
+                options["reducer"], rsource = self._importpath(
+                    options["reducer"], "The reducer of %r" % cmd.name)
+                if rsource:
+                    files.add(os.path.abspath(rsource))
+            # Default values are kept as their repr(), and read back with
+            # ast.literal_eval()
+            keywords = {}
+            for key, value in cmd.keywords.items():
+                keywords[key] = repr(value)
+                try:
+                    same = ast.literal_eval(keywords[key]) == value
+                except (ValueError, SyntaxError):
+                    same = False
+                if not same:
+                    raise ValueError("The default value of %r in command %r "
+                                     "can't be saved" % (key, cmd.name))
+            entries.append({"name": cmd.name,
+                            "target": target,
+                            "source": source,
+                            "argnames": cmd.argnames,
+                            "keywords": keywords,
+                            "shortopts": cmd.shortopts,
+                            "has_varargs": cmd.has_varargs,
+                            "has_kwargs": cmd.has_kwargs,
+                            "docstring": cmd.docstring,
+                            "varargs_name": cmd.varargs_name,
+                            "paramdocs": cmd.paramdocs,
+                            "default": cmd is self.defaultcommand,
+                            "files": cmd.files,
+                            "options": options,
+                            "global": cmd is self.globalcommand})
+
+        manifest = {"version": MANIFEST_VERSION,
+                    "files": dict((f, self._filekey(f)) for f in files),
+                    "commands": entries}
+        # Write to a temporary file and rename it, so concurrent runs never
+        # see a partially written manifest
+        dirname = os.path.dirname(os.path.abspath(path))
+        import tempfile
+        fd, tmppath = tempfile.mkstemp(dir=dirname, prefix=".baker")
+        try:
+            with os.fdopen(fd, "w") as fobj:
+                json.dump(manifest, fobj, sort_keys=True)
+            _replacefile(tmppath, path)
+        except Exception:
+            os.unlink(tmppath)
+            raise
+
+    def readmanifest(self, path):
+        """
+        Registers the commands stored in a manifest written by
+        writemanifest(), without importing their modules. Each module is
+        imported when one of its commands is called. Returns False, and
+        registers nothing, if the manifest is missing or out of date::
+
+            b = Baker()
+            if not b.readmanifest(cachefile):
+                import myapp.commands
+                b.writemanifest(cachefile)
+            b.run()
+
+        :param path: the file name of the manifest.
+        """
+        import ast
+        try:
+            with open(path) as fobj:
+                manifest = json.load(fobj)
+            if manifest["version"] != MANIFEST_VERSION:
+                return False
+            for filename, key in manifest["files"].items():
+                # JSON has no tuples
+                if self._filekey(filename) != (key and tuple(key)):
+                    return False
+            for entry in manifest["commands"]:
+                entry["keywords"] = dict(
+                    (key, ast.literal_eval(value))
+                    for key, value in entry["keywords"].items())
+                reducer = entry["options"].get("reducer")
+                if reducer is not None:
+                    entry["options"]["reducer"] = LazyFunction(reducer)
+        except Exception:
+            return False
+
+        self._helpcache.clear()
+        for entry in manifest["commands"]:
+            parser = compile_parser(entry["argnames"], entry["keywords"],
+                                    entry["shortopts"], entry["has_kwargs"])
+            cmd = Cmd(entry["name"],
+                      LazyFunction(entry["target"], entry["source"]),
+                      entry["argnames"], entry["keywords"],
+                      entry["shortopts"], entry["has_varargs"],
+                      entry["has_kwargs"], entry["docstring"],
+                      entry["varargs_name"], entry["paramdocs"], False,
+                      parser, entry["files"], entry["options"])
+            if entry["global"]:
+                self.globalcommand = cmd
+                self.global_options = cmd.keywords
+            else:
+                self.commands[cmd.name] = cmd
+            if entry["default"]:
+                self.defaultcommand = cmd
+        return True
+
+    @staticmethod
+    def _importpath(fn, what):
+        """
+        Returns the "package.module:function" path of a function and the
+        file it's defined in, for writemanifest(). Raises ValueError if the
+        function can't be imported by name.
+        """
+        if isinstance(fn, LazyFunction):
+            return fn.target, fn.source
+        module = sys.modules.get(getattr(fn, "__module__", None))
+        fnname = getattr(fn, "__name__", None)
+        if module is None or getattr(module, fnname or "", None) is not fn:
+            raise ValueError("%s can't be imported by name" % what)
+        source = getattr(module, "__file__", None)
+        if source and source[-4:] in (".pyc", ".pyo"):
+            source = source[:-1]
+        return "%s:%s" % (module.__name__, fnname), source
+
+    @staticmethod
+    def _filekey(filename):
+        """
+        Returns the modification time and size of a file, or None if it
+        doesn't exist.
+        """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
     @staticmethod
     def write(fobj, content, convert=True):
         """
@@ -394,15 +2185,27 @@ class Baker(object):
         :param scriptname: the name of the script being executed (argv[0]).
         :param fobj: the file to write the help to. The default is stdout.
         """
+        key = (scriptname, None)
+        if key not in self._helpcache:
+            self._helpcache[key] = self.format_top_help(scriptname)
+        self.write(fobj, self._helpcache[key])
+
+    def format_top_help(self, scriptname):
+        """
+        Returns the documentation for the script as a string.
+
+        :param scriptname: the name of the script being executed (argv[0]).
+        """
+        out = []
         # show global command usage if have one
         if self.globalcommand:
-            self.write(fobj, "\n".join(self.return_cmd_doc(self.globalcommand)))
-            self.write(fobj, "\n".join(self.return_argnames_doc(self.globalcommand)))
-            self.write(fobj, "\n".join(self.return_keyword_doc(self.globalcommand)))
-            self.write(fobj, "\n")
+            out.append("\n".join(self.return_cmd_doc(self.globalcommand)))
+            out.append("\n".join(self.return_argnames_doc(self.globalcommand)))
+            out.append("\n".join(self.return_keyword_doc(self.globalcommand)))
+            out.append("\n")
 
         # Print the basic help for running a command
-        self.write(fobj, "Usage: %s COMMAND <options>\n\n" % scriptname)
+        out.append("Usage: %s COMMAND <options>\n\n" % scriptname)
 
         # Get a sorted list of all command names
         cmdnames = sorted(self.commands.keys())
@@ -412,12 +2215,12 @@ class Baker(object):
             # after)
             rindent = max(len(name) for name in cmdnames) + 3
 
-            self.write(fobj, "Available commands:\n")
+            out.append("Available commands:\n")
             for cmdname in cmdnames:
                 # Get the Cmd object for this command
                 cmd = self.commands[cmdname]
 
-                self.write(fobj, " " + cmdname)
+                out.append(" " + cmdname)
 
                 # Get the paragraphs of the command's docstring
                 paras = process_docstring(cmd.docstring)
@@ -425,19 +2228,18 @@ class Baker(object):
                     # Calculate the padding necessary to fill from the end of the
                     # command name to the documentation margin
                     tab = " " * (rindent - len(cmdname) - 1)
-                    self.write(fobj, tab)
+                    out.append(tab)
 
                     # Print the first paragraph
-                    self.write(fobj, "\n".join(format_paras([paras[0]], 76,
-                                               indent=rindent,
-                                               lstripline=[0])))
-                    self.write(fobj, "\n")
-                else:
-                    self.write(fobj, "\n")
+                    out.append("\n".join(format_paras([paras[0]], 76,
+                                                      indent=rindent,
+                                                      lstripline=[0])))
+                out.append("\n")
 
-        self.write(fobj, "\n")
-        self.write(fobj, "Use '%s <command> --help' for individual command "
+        out.append("\n")
+        out.append("Use '%s <command> --help' for individual command "
                    "help.\n" % scriptname)
+        return "".join(out)
 
     def return_cmd_doc(self, cmd):
         """
@@ -564,30 +2366,48 @@ class Baker(object):
         :param cmd: the Cmd object representing the command.
         :param fobj: the file to write the help to. The default is stdout.
         """
+        # Only cache the help of registered commands, so a stale entry can't
+        # be returned for a different Cmd object with the same name
+        if self.commands.get(cmd.name) is not cmd:
+            self.write(fobj, self.format_command_help(scriptname, cmd))
+            return
+        key = (scriptname, cmd.name)
+        if key not in self._helpcache:
+            self._helpcache[key] = self.format_command_help(scriptname, cmd)
+        self.write(fobj, self._helpcache[key])
+
+    def format_command_help(self, scriptname, cmd):
+        """
+        Returns the documentation for a specific command as a string.
+
+        :param scriptname: the name of the script being executed (argv[0]).
+        :param cmd: the Cmd object representing the command.
+        """
 
         # Print the usage for the command
-        self.write(fobj, "Usage: %s %s" % (scriptname, cmd.name))
+        out = ["Usage: %s %s" % (scriptname, cmd.name)]
 
         # Print the required and "optional" arguments (where optional
         # arguments are keyword arguments with default None).
         for name in cmd.argnames:
             if name not in cmd.keywords:
                 # This is a positional argument
-                self.write(fobj, " <%s>" % name)
+                out.append(" <%s>" % name)
             else:
                 # This is a keyword/optional argument
-                self.write(fobj, " [<%s>]" % name)
+                out.append(" [<%s>]" % name)
 
         if cmd.has_varargs:
             # This command accepts a variable number of positional arguments
-            self.write(fobj, " [<%s>...]" % (cmd.varargs_name))
-        self.write(fobj, "\n\n")
+            out.append(" [<%s>...]" % (cmd.varargs_name))
+        out.append("\n\n")
 
-        self.write(fobj, "\n".join(self.return_cmd_doc(cmd)))
-        self.write(fobj, "\n".join(self.return_argnames_doc(cmd)))
-        self.write(fobj, "\n".join(self.return_keyword_doc(cmd)))
+        out.append("\n".join(self.return_cmd_doc(cmd)))
+        out.append("\n".join(self.return_argnames_doc(cmd)))
+        out.append("\n".join(self.return_keyword_doc(cmd)))
         if self.globalcommand is not None:
-            self.write(fobj, "\n".join(self.return_cmd_doc(cmd)))
+            out.append("\n".join(self.return_cmd_doc(cmd)))
+        return "".join(out)
 
     def parse_args(self, scriptname, cmd, argv, test=False):
         """
@@ -598,28 +2418,37 @@ class Baker(object):
         :param argv: The argument list.
         :param test: If True prints to stdout.
         """
-        keywords = cmd.keywords
-        shortopts = cmd.shortopts
-
-        def type_error(name, value, t):
-            if not test:
-                msg = "%s value %r must be %s" % (name, value, t)
-                raise CommandError(msg, scriptname, cmd)
-
-        # shortopts maps long option names to characters. To look up short
-        # options, we need to create a reverse mapping.
-        shortchars = dict((v, k) for k, v in shortopts.items())
+        table = cmd.parser
+        shortchars = table.shortchars
+        converters = table.converters
+        flags = table.flags
+
+        def convert(name, value):
+            try:
+                return converters.get(name, identity)(value)
+            except (TypeError, ValueError):
+                if not test:
+                    msg = "%s value %r must be %s" % (
+                        name, value, type(cmd.keywords.get(name)))
+                    raise CommandError(msg, scriptname, cmd)
+                return value
 
         # The *args list and **kwargs dict to build up from the command line
         # arguments
         vargs = []
         kwargs = {}
 
+        # Walk the argument list with a cursor instead of popping items off
+        # the front of it, which would be quadratic in the number of
+        # arguments and would modify the caller's list.
+        pos = 0
+        end = len(argv)
         double_dash = 0
         single_dash = 0
-        while argv:
+        while pos < end:
             # Take the next argument
-            arg = argv.pop(0)
+            arg = argv[pos]
+            pos += 1
 
             if arg == "--":
                 double_dash += 1
@@ -627,7 +2456,7 @@ class Baker(object):
                     raise CommandError("You cannot specify -- more than once")
                 # All arguments following a double hyphen are treated as
                 # positional arguments
-                vargs.extend(argv)
+                vargs.extend(argv[pos:])
                 break
 
             elif arg == "-":
@@ -640,48 +2469,37 @@ class Baker(object):
             elif arg.startswith("--"):
                 # Process long option
 
-                value = None
                 if "=" in arg:
                     # The argument was specified like --keyword=value
                     name, value = arg[2:].split("=", 1)
                     # strip quotes if value is quoted like
                     # --keyword='multiple words'
-                    value = value.strip('\'"')
-
-                    default = keywords.get(name)
-                    try:
-                        value = totype(value, default)
-                    except (TypeError, ValueError):
-                        type_error(name, value, type(default))
+                    value = convert(name, value.strip('\'"'))
                 else:
                     # The argument was not specified with an equals sign...
                     name = arg[2:]
-                    default = keywords.get(name)
 
-                    if type(default) is bool:
+                    if name in flags:
                         # If this option is a boolean, it doesn't need a value;
                         # specifying it on the command line means "do the
                         # opposite of the default".
-                        value = not default
+                        value = flags[name]
                     else:
                         # The next item in the argument list is the value, i.e.
                         # --keyword value
-                        if not argv or argv[0].startswith("-"):
+                        if pos == end or argv[pos].startswith("-"):
                             # Oops, there isn't a value available... just use
                             # True, assuming this is a flag.
                             value = True
                         else:
-                            value = argv.pop(0)
-
-                        try:
-                            value = totype(value, default)
-                        except (TypeError, ValueError):
-                            type_error(name, value, type(default))
+                            value = argv[pos]
+                            pos += 1
+                        value = convert(name, value)
 
                 # Store this option
                 kwargs[name] = value
 
-            elif arg.startswith("-") and (cmd.shortopts or cmd.has_kwargs):
+            elif arg.startswith("-") and table.has_shortopts:
                 # Process short option(s)
 
                 # For each character after the '-'...
@@ -689,25 +2507,24 @@ class Baker(object):
                     char = arg[i]
                     if cmd.has_kwargs:
                         name = char
-                        default = keywords.get(name)
                     elif char not in shortchars:
                         continue
                     else:
                         # Get the long option name corresponding to this char
                         name = shortchars[char]
-                        default = keywords[name]
 
-                    if isinstance(default, bool):
+                    if name in flags:
                         # If this option is a boolean, it doesn't need a value;
                         # specifying it on the command line means "do the
                         # opposite of the default".
-                        kwargs[name] = not default
+                        kwargs[name] = flags[name]
                     else:
                         # This option requires a value...
                         if i == len(arg) - 1:
                             # This is the last character in the list, so the
                             # next argument on the command line is the value.
-                            value = argv.pop(0)
+                            value = argv[pos]
+                            pos += 1
                         else:
                             # There are other characters after this one, so
                             # the rest of the characters must represent the
@@ -718,11 +2535,7 @@ class Baker(object):
                         # means the option/value were specified as opt=value
                         # Then remove quotes.
                         value = value.lstrip("=").strip("'\"")
-
-                        try:
-                            kwargs[name] = totype(value, default)
-                        except (TypeError, ValueError):
-                            type_error(name, value, type(default))
+                        kwargs[name] = convert(name, value)
                         break
             else:
                 # This doesn't start with "-", so just add it to the list of
@@ -744,8 +2557,21 @@ class Baker(object):
         :param argv: the list of options passed to the command line (sys.argv).
         """
 
+        self.timings = {}
+        started = clock()
+        scriptname, cmd, args, kwargs = self._parse(argv, test)
+        # Importing commands and calling the global command are phases of
+        # their own
+        self.timings["parse"] = (clock() - started
+                                 - self.timings.get("import", 0)
+                                 - self.timings.get("global_apply", 0))
+        self.fire("after_parse", cmd, args, kwargs)
+        return scriptname, cmd, args, kwargs
+
+    def _parse(self, argv, test):
         if argv is None:
             argv = sys.argv
+        argv = self.parse_reserved(argv)
 
         scriptname = argv[0]
         argv_len = len(argv)
@@ -760,14 +2586,14 @@ class Baker(object):
 
             elif argv[1] == "help":
                 if argv_len > 2 and argv[2] in self.commands:
-                    cmd = self.commands[argv[2]]
+                    cmd = self.resolve(self.commands[argv[2]])
                     raise CommandHelp(scriptname, cmd)
                 raise TopHelp(scriptname)
 
         if argv_len > 1 and argv[1] in self.commands:
             # The first argument on the command line (after the script name
             # is the command to run.
-            cmd = self.commands[argv[1]]
+            cmd = self.resolve(self.commands[argv[1]])
 
             if argv_len > 2 and (argv[2] == "-h" or argv[2] == "--help"):
                 raise CommandHelp(scriptname, cmd)
@@ -782,9 +2608,10 @@ class Baker(object):
             # First, get the name of the real command.
             # It cannot be after an option (--opt) except when that option
             # is a boolean (i.e. does not have a value).
+            flags = self.globalcommand.parser.flags
             for i, arg in enumerate(argv[1:], 1):
                 prev = argv[i - 1]
-                is_prev_bool = isinstance(self.get(prev.lstrip('-')), bool)
+                is_prev_bool = prev.lstrip('-') in flags
                 candidate = not prev.startswith('-') or is_prev_bool
                 if arg in self.commands and candidate:
                     break
@@ -795,7 +2622,7 @@ class Baker(object):
                                            global_args, test=test)
             self.global_options = self.apply(scriptname, self.globalcommand,
                                              args, kwargs)
-            cmd = self.commands[argv[i]]
+            cmd = self.resolve(self.commands[argv[i]])
         else:
             raise CommandError("No command specified", scriptname)
 
@@ -804,9 +2631,323 @@ class Baker(object):
         args, kwargs = self.parse_args(scriptname, cmd, options, test=test)
         return (scriptname, cmd, args, kwargs)
 
+    def parse_reserved(self, argv):
+        """
+        Removes the RESERVED_OPTIONS given before the command name from the
+        command line and stores them in self.reserved. Returns the rest of
+        the command line.
+        """
+        self.reserved = {}
+        i = 1
+        while i < len(argv) and argv[i].partition("=")[0] in RESERVED_OPTIONS:
+            name, equals, value = argv[i].partition("=")
+            self.reserved[name[2:]] = value if equals else True
+            i += 1
+        return argv[:1] + argv[i:]
+
+    @contextmanager
+    def profiling(self, errorfile=sys.stderr):
+        """
+        Runs the body of the with statement under cProfile if the
+        ``--baker-profile`` option was given. The statistics are saved to
+        the file given as ``--baker-profile=FILE``, or the profile_limit
+        entries with the most cumulative time are printed to 'errorfile'.
+        """
+        dest = self.reserved.get("baker-profile")
+        if not dest:
+            yield
+            return
+
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            if dest is True:
+                out = StringIO()
+                stats = pstats.Stats(profiler, stream=out)
+                stats.sort_stats("cumulative").print_stats(self.profile_limit)
+                self.write(errorfile, out.getvalue())
+            else:
+                profiler.dump_stats(dest)
+
+    @contextmanager
+    def sampling(self, errorfile=sys.stderr):
+        """
+        Runs a StackSampler during the body of the with statement if the
+        ``--baker-sample[=HZ[:FILE]]`` option was given. The collapsed
+        stacks are written to FILE, or to 'errorfile'. HZ defaults to 100.
+        """
+        option = self.reserved.get("baker-sample")
+        if not option:
+            yield
+            return
+
+        hz, _, dest = ("" if option is True else option).partition(":")
+        try:
+            hz = float(hz or 100)
+            if hz <= 0:
+                raise ValueError
+        except ValueError:
+            raise CommandError("Invalid sampling rate in --baker-sample=%s"
+                               % option, None)
+        sampler = StackSampler(hz)
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            if dest:
+                with open(dest, "w") as fobj:
+                    fobj.write(sampler.collapsed())
+            else:
+                self.write(errorfile, sampler.collapsed())
+
+    @contextmanager
+    def memory(self, cmd, errorfile=sys.stderr):
+        """
+        Measures the memory used by the body of the with statement if the
+        ``--baker-mem[=FILE]`` option was given. The report has the peak
+        memory allocated by Python code, the mem_limit source lines that
+        allocated the most memory still held at the end, and the maximum
+        resident set size of the process before and after. It's printed to
+        'errorfile', or saved to FILE as JSON.
+
+        The Python allocations are traced with tracemalloc (Python 3.4+),
+        which slows the command down. The resident set size comes from the
+        resource module on Unix.
+        """
+        dest = self.reserved.get("baker-mem")
+        if not dest:
+            yield
+            return
+
+        try:
+            import tracemalloc
+        except ImportError:  # pragma: no cover
+            tracemalloc = None
+        report = {"command": cmd.name, "peak": None, "maxrss_before": maxrss(),
+                  "maxrss_after": None, "lines": []}
+        # Python may have been started with tracing on (-X tracemalloc)
+        tracing = tracemalloc is not None and tracemalloc.is_tracing()
+        if tracemalloc is not None:
+            if not tracing:
+                tracemalloc.start()
+            # Only what is allocated from now on is reported. The import
+            # machinery is left out, as lazy imports would dominate the
+            # report.
+            ignored = [tracemalloc.Filter(False, tracemalloc.__file__),
+                       tracemalloc.Filter(False, "<frozen importlib.*>")]
+            start = tracemalloc.take_snapshot().filter_traces(ignored)
+        try:
+            yield
+        finally:
+            report["maxrss_after"] = maxrss()
+            if tracemalloc is not None:
+                report["peak"] = tracemalloc.get_traced_memory()[1]
+                snapshot = tracemalloc.take_snapshot().filter_traces(ignored)
+                if not tracing:
+                    tracemalloc.stop()
+                stats = [stat for stat in snapshot.compare_to(start, "lineno")
+                         if stat.size_diff > 0]
+                for stat in stats[:self.mem_limit]:
+                    frame = stat.traceback[0]
+                    report["lines"].append({"file": frame.filename,
+                                            "line": frame.lineno,
+                                            "size": stat.size_diff,
+                                            "count": stat.count_diff})
+            if dest is True:
+                self.write(errorfile, formatmemory(report))
+            else:
+                with open(dest, "w") as fobj:
+                    json.dump(report, fobj, indent=2)
+
     def apply(self, scriptname, cmd, args, kwargs, instance=None):
         """
-        Calls the command function.
+        Calls the command function, timing it as the "apply" phase, or the
+        "global_apply" phase for the global command.
+        """
+        started = clock()
+        imported = self.timings.get("import", 0)
+        value = self.call(scriptname, cmd, args, kwargs, instance)
+        phase = "global_apply" if cmd is self.globalcommand else "apply"
+        self.timings[phase] = (clock() - started
+                               - (self.timings.get("import", 0) - imported))
+        self.fire("after_" + phase, cmd, args, kwargs)
+        return value
+
+    def call(self, scriptname, cmd, args, kwargs, instance=None):
+        """
+        Calls the command function with the arguments parsed from the command
+        line.
+        """
+        newargs, newkwargs = self.arrange(scriptname, cmd, args, kwargs)
+        if cmd.options.get("split_input"):
+            return self.applysplit(cmd, newargs, newkwargs, scriptname)
+        if cmd.options.get("map_varargs"):
+            return self.applymap(cmd, newargs, newkwargs, instance)
+        fn = self.load(cmd)
+        handles = self.openfiles(cmd, newargs, newkwargs)
+        try:
+            if cmd.is_method and instance is not None:
+                value = fn(instance, *newargs, **newkwargs)
+            else:
+                value = fn(*newargs, **newkwargs)
+            # Coroutine functions and async generators are run on an event
+            # loop
+            value = await_result(value)
+        except BaseException:
+            for handle in handles:
+                handle.discard()
+            raise
+        if handles and isiterator(value):
+            # The files are used as the result is iterated over
+            return closefiles(value, handles)
+        for handle in handles:
+            handle.close()
+        return value
+
+    def applysplit(self, cmd, args, kwargs, scriptname=None):
+        """
+        Calls the function of a command with split_input for each part of its
+        input file in a pool of processes, and returns the combined result.
+        Raises CommandError if no input file was given.
+        """
+        futures = importfutures("split_input")
+        name = cmd.options["split_input"]
+        workers = cmd.options.get("workers")
+        if not workers:
+            import multiprocessing
+            workers = multiprocessing.cpu_count()
+        index = cmd.argnames.index(name)
+        if index < len(args):
+            filein = args[index]
+        else:
+            filein = kwargs.get(name, cmd.keywords.get(name))
+        if filein is None:
+            raise CommandError("%r requires an input file for %r"
+                               % (cmd.name, name), scriptname, cmd)
+
+        def calls(chunks):
+            for chunk in chunks:
+                newargs, newkwargs = list(args), dict(kwargs)
+                if index < len(args):
+                    newargs[index] = chunk
+                else:
+                    newkwargs[name] = chunk
+                yield newargs, newkwargs
+
+        if filein == "-":
+            compressed = True
+        else:
+            with io.open(filein, "rb") as fobj:
+                compressed = sniff(fobj.read(6)) is not None
+        fobj = None
+        if compressed:
+            fobj = openinput(filein)
+            # Many small blocks would make pickling the bottleneck
+            chunks = (InputChunk(filein, data=data)
+                      for data in lineblocks(fobj, BUFFER_SIZE * 16))
+        else:
+            # Several parts for each worker even out the differences in
+            # the time they take
+            chunks = (InputChunk(filein, start, end)
+                      for start, end in linechunks(filein, workers * 4))
+
+        pool = futures.ProcessPoolExecutor(workers)
+        values = self._chunkresults(pool, self.load(cmd), calls(chunks),
+                                    workers * 2)
+        try:
+            reducer = cmd.options.get("reducer")
+            if reducer is None:
+                return list(values)
+            return reduce(reducer, values)
+        finally:
+            # Cancels the calls that haven't started after an error
+            values.close()
+            pool.shutdown()
+            if fobj is not None:
+                fobj.close()
+
+    def applymap(self, cmd, args, kwargs, instance=None):
+        """
+        Calls the function of a command with map_varargs for each item of its
+        ``*varargs`` in a pool of threads or processes. Returns a MapResults
+        iterator.
+        """
+        futures = importfutures("map_varargs")
+        fn = self.load(cmd)
+        if cmd.is_method and instance is not None:
+            fn = partial(fn, instance)
+        nslots = len(cmd.parser.slots)
+        fixed = args[:nslots]
+        calls = [(item, fn, fixed + [item], kwargs) for item in args[nslots:]]
+
+        workers = cmd.options.get("workers")
+        if cmd.options.get("executor") == "process":
+            pool = futures.ProcessPoolExecutor(workers)
+        else:
+            try:
+                pool = futures.ThreadPoolExecutor(
+                    workers, thread_name_prefix="baker-map")
+            except TypeError:  # pragma: no cover
+                # Before Python 3.6
+                pool = futures.ThreadPoolExecutor(workers or 8)
+        return MapResults(self._results(pool, calls, True))
+
+    def openfiles(self, cmd, args, kwargs):
+        """
+        Replaces the names of files given for the file parameters of the
+        command with LazyFile objects, or PooledFile objects for the
+        ``*varargs`` of a command with 'maxopen' set. The arrange()d
+        arguments are changed in place. Returns the list of file objects.
+        """
+        handles = []
+        if not cmd.files:
+            return handles
+
+        def lazy(value, mode):
+            if not isinstance(value, string_types):
+                # None or a default that isn't a file name
+                return value
+            handle = LazyFile(value, mode, cmd.options.get("prefetch"))
+            handles.append(handle)
+            return handle
+
+        nslots = len(cmd.parser.slots)
+        given = set()
+        for i, (name, _) in enumerate(cmd.parser.slots[:len(args)]):
+            given.add(name)
+            if name in cmd.files:
+                args[i] = lazy(args[i], cmd.files[name])
+        for name, mode in cmd.files.items():
+            if name in kwargs:
+                kwargs[name] = lazy(kwargs[name], mode)
+            elif name in cmd.keywords and name not in given:
+                # The default is a file name too, e.g. "-"
+                kwargs[name] = lazy(cmd.keywords[name], mode)
+        if cmd.varargs_name in cmd.files:
+            mode = cmd.files[cmd.varargs_name]
+            maxopen = cmd.options.get("maxopen")
+            if maxopen and mode == "r":
+                pool = FilePool(maxopen)
+                for i in range(nslots, len(args)):
+                    if isinstance(args[i], string_types):
+                        args[i] = pool.open(args[i])
+                        handles.append(args[i])
+            else:
+                args[nslots:] = [lazy(value, mode)
+                                 for value in args[nslots:]]
+        return handles
+
+    def arrange(self, scriptname, cmd, args, kwargs):
+        """
+        Checks the arguments parsed from the command line and rearranges them
+        into the positional and keyword arguments the command function
+        should be called with. Returns a tuple of (list, dict).
         """
 
         # Create a list of positional arguments: arguments that are either
@@ -818,9 +2959,13 @@ class Baker(object):
         # Rearrange the arguments into the order Python expects
         newargs = []
         newkwargs = kwargs.copy()
-        for name in cmd.argnames:
-            if name in cmd.keywords:
-                if not args:
+        # Index of the next bare argument to use. The args list itself is left
+        # untouched.
+        pos = 0
+        nargs = len(args)
+        for name, is_keyword in cmd.parser.slots:
+            if is_keyword:
+                if pos == nargs:
                     break
                 # keyword arg
                 if cmd.has_varargs:
@@ -833,7 +2978,8 @@ class Baker(object):
                         del newkwargs[name]
                     newargs.append(value)
                 elif not name in newkwargs:
-                    newkwargs[name] = args.pop(0)
+                    newkwargs[name] = args[pos]
+                    pos += 1
 
             else:
                 # positional arg
@@ -841,33 +2987,297 @@ class Baker(object):
                     newargs.append(newkwargs[name])
                     del newkwargs[name]
                 else:
-                    if args:
-                        newargs.append(args.pop(0))
+                    if pos < nargs:
+                        newargs.append(args[pos])
+                        pos += 1
                     else:
                         # This argument is required but we don't have a bare
                         # arg to fill it
                         msg = "Required argument %r not given"
                         raise CommandError(msg % (name), scriptname, cmd)
-        if args:
+        if pos < nargs:
             if cmd.has_varargs:
-                newargs.extend(args)
+                newargs.extend(args[pos:])
             else:
                 msg = "Too many arguments to %r: %s"
-                raise CommandError(msg % (cmd.name, args), scriptname, cmd)
+                raise CommandError(msg % (cmd.name, args[pos:]), scriptname,
+                                   cmd)
 
         if not cmd.has_kwargs:
             for k in newkwargs:
                 if k not in cmd.keywords:
                     raise CommandError("Unknown option --%s" % k,
                                        scriptname, cmd)
+        return newargs, newkwargs
 
-        if cmd.is_method and instance is not None:
-            return cmd.fn(instance, *newargs, **newkwargs)
-        return cmd.fn(*newargs, **newkwargs)
+    def run_many(self, argvs, workers=None, ordered=True):
+        """
+        Runs many command lines in parallel in a pool of processes. All the
+        command lines are parsed first, so a CommandError is raised before
+        any command runs. Returns an iterator of Result objects, which are
+        yielded as the commands finish: in the same order as 'argvs' if
+        'ordered' is True, or as soon as each one is done otherwise. The
+        command functions, their arguments and return values must be
+        picklable. Commands with file parameters, split_input or map_varargs
+        can't be run this way.
+
+        Requires the concurrent.futures module (Python 3.2+, or the
+        "futures" package on Python 2).
+
+        :param argvs: a list of argument lists, like sys.argv.
+        :param workers: the number of processes, defaults to the number of
+            CPUs.
+        :param ordered: if False, yield results as soon as they are ready.
+        """
+        futures = importfutures("run_many()")
+        calls = [self._directcall(argv, "run_many()") for argv in argvs]
+        pool = futures.ProcessPoolExecutor(workers)
+        return self._results(pool, calls, ordered)
+
+    def run_many_async(self, argvs, limit=100, ordered=True):
+        """
+        Runs many command lines concurrently on one asyncio event loop, with
+        at most 'limit' coroutines in progress at a time. Like run_many(),
+        all the command lines are parsed first and an iterator of Result
+        objects is returned. Commands that aren't coroutine functions are
+        simply called in turn, and the same commands as in run_many() are
+        rejected.
+
+        :param argvs: a list of argument lists, like sys.argv.
+        :param limit: the maximum number of commands running at once.
+        :param ordered: if False, yield results as soon as they are ready.
+        """
+        calls = [self._directcall(argv, "run_many_async()")
+                 for argv in argvs]
+        return self._async_results(calls, limit, ordered)
+
+    def _directcall(self, argv, caller):
+        """
+        Parses a command line for run_many() or run_many_async(), which call
+        the command function directly, and returns a tuple of (argv, fn,
+        args, kwargs). Commands with file parameters, split_input or
+        map_varargs need call() to run, so they are rejected.
+        """
+        scriptname, cmd, args, kwargs = self.parse(argv)
+        if (cmd.files or cmd.options.get("split_input")
+                or cmd.options.get("map_varargs")):
+            raise CommandError("%s can't run %r, which has file parameters, "
+                               "split_input or map_varargs"
+                               % (caller, cmd.name), scriptname, cmd)
+        newargs, newkwargs = self.arrange(scriptname, cmd, args, kwargs)
+        return argv, self.load(cmd), newargs, newkwargs
+
+    @staticmethod
+    def _async_results(calls, limit, ordered):
+        """
+        Runs (item, fn, args, kwargs) calls on an event loop and yields a
+        Result for each of them.
+        """
+        import asyncio
+        loop = asyncio.new_event_loop()
+        # Maps running tasks to the index of their call and the time they
+        # were started
+        running = {}
+        # Finished results that can't be yielded yet to keep them in order
+        finished = {}
+        nextcall = nextresult = 0
+        try:
+            while nextresult < len(calls):
+                # Start calls until there are 'limit' tasks in progress
+                while nextcall < len(calls) and len(running) < limit:
+                    _, fn, args, kwargs = calls[nextcall]
+                    started = clock()
+                    try:
+                        value = fn(*args, **kwargs)
+                    except Exception as e:
+                        finished[nextcall] = (None, e, clock() - started)
+                    else:
+                        if iscoroutine(value):
+                            task = loop.create_task(value)
+                            running[task] = (nextcall, started)
+                        else:
+                            finished[nextcall] = (value, None,
+                                                  clock() - started)
+                    nextcall += 1
+
+                if running:
+                    done, _ = loop.run_until_complete(asyncio.wait(
+                        list(running), return_when=asyncio.FIRST_COMPLETED))
+                    for task in done:
+                        index, started = running.pop(task)
+                        exception = task.exception()
+                        value = None if exception else task.result()
+                        finished[index] = (value, exception,
+                                           clock() - started)
+
+                if ordered:
+                    indexes = []
+                    while nextresult in finished:
+                        indexes.append(nextresult)
+                        nextresult += 1
+                else:
+                    indexes = list(finished)
+                    nextresult += len(indexes)
+                for index in indexes:
+                    value, exception, elapsed = finished.pop(index)
+                    yield Result(calls[index][0], value, exception, elapsed)
+        finally:
+            for task in running:
+                task.cancel()
+            if running:
+                loop.run_until_complete(asyncio.wait(list(running)))
+            loop.close()
+
+    @staticmethod
+    def _results(pool, calls, ordered):
+        """
+        Submits (item, fn, args, kwargs) calls to the executor and yields a
+        Result for each of them.
+        """
+        futures = importfutures("Running commands in parallel")
+        with pool:
+            submitted = [pool.submit(timedcall, fn, args, kwargs)
+                         for _, fn, args, kwargs in calls]
+            items = dict((future, call[0])
+                         for future, call in zip(submitted, calls))
+            try:
+                if ordered:
+                    done = submitted
+                else:
+                    done = futures.as_completed(submitted)
+                for future in done:
+                    try:
+                        value, exception, elapsed = future.result()
+                    except Exception as e:
+                        # The call itself failed, e.g. the result couldn't
+                        # be pickled
+                        value, exception, elapsed = None, e, None
+                    yield Result(items[future], value, exception, elapsed)
+            finally:
+                for future in submitted:
+                    future.cancel()
+
+    @staticmethod
+    def _chunkresults(pool, fn, calls, limit):
+        """
+        Submits (args, kwargs) calls to the executor, with at most 'limit'
+        of them waiting at a time, and yields their return values in order.
+        Raises the first exception raised by a call.
+        """
+        pending = deque()
+        try:
+            for args, kwargs in calls:
+                pending.append(pool.submit(timedcall, fn, args, kwargs))
+                while len(pending) >= limit or (pending and
+                                                pending[0].done()):
+                    value, exception, _ = pending.popleft().result()
+                    if exception is not None:
+                        raise exception
+                    yield value
+            while pending:
+                value, exception, _ = pending.popleft().result()
+                if exception is not None:
+                    raise exception
+                yield value
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def outputmap(self, outfile, errorfile, results):
+        """
+        Writes the values of the MapResults returned by a command with
+        map_varargs to the output file, and the errors to the error file.
+        Returns the number of items that failed.
+        """
+        total = failures = 0
+        try:
+            for result in results:
+                total += 1
+                if result.exception is None:
+                    if result.value is not None:
+                        self.write(outfile, str(result.value) + '\n')
+                else:
+                    failures += 1
+                    self.write(errorfile, "%s: %s: %s\n"
+                               % (result.item,
+                                  type(result.exception).__name__,
+                                  result.exception))
+            flush = getattr(outfile, "flush", None)
+            if flush is not None:
+                flush()
+        except (IOError, OSError) as e:
+            if e.errno != errno.EPIPE:
+                raise
+            # Cancel the items that haven't started, as in output()
+            results.close()
+            self.pipeclosed(outfile)
+        if failures:
+            self.write(errorfile, "%d of %d items failed\n"
+                       % (failures, total))
+        return failures
+
+    def output(self, outfile, value):
+        """
+        Writes the return value of a command to the output file. The items
+        of an iterator, such as a generator or an async generator, are
+        written one per line as they are produced, without keeping them in
+        memory. They are written in batches, and the output file is flushed
+        at least every OUTPUT_INTERVAL seconds.
+        """
+        flush = getattr(outfile, "flush", None) or (lambda: None)
+        try:
+            if not isiterator(value):
+                self.write(outfile, str(value) + '\n')
+                flush()
+                return
+            batch = []
+            size = 0
+            flushed = clock()
+            for item in value:
+                line = str(item) + '\n'
+                batch.append(line)
+                size += len(line)
+                if (size >= OUTPUT_BATCH
+                        or clock() - flushed >= OUTPUT_INTERVAL):
+                    self.write(outfile, "".join(batch))
+                    flush()
+                    batch = []
+                    size = 0
+                    flushed = clock()
+            if batch:
+                self.write(outfile, "".join(batch))
+            flush()
+        except (IOError, OSError) as e:
+            if e.errno != errno.EPIPE:
+                raise
+            # Stop producing output nobody reads. The finally clause closes
+            # the generator, which runs its cleanup code.
+            self.pipeclosed(outfile)
+        finally:
+            # Close generators so their cleanup code runs, but leave other
+            # values with a close() method alone
+            if isiterator(value) and hasattr(value, "close"):
+                value.close()
+
+    def pipeclosed(self, outfile):
+        """
+        Called when writing to the output file fails because its reader has
+        gone away. Points the output file at os.devnull, so that flushing it
+        when Python exits doesn't fail again, and exits with the status of a
+        process killed by SIGPIPE, without a traceback.
+        """
+        try:
+            fd = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(fd, outfile.fileno())
+            os.close(fd)
+        except (AttributeError, ValueError, OSError):
+            # Not a real file
+            pass
+        sys.exit(EXIT_SIGPIPE)
 
     def run(self, argv=None, main=True, help_on_error=False,
             outfile=sys.stdout, errorfile=sys.stderr, helpfile=sys.stdout,
-            errorcode=1, instance=None):
+            errorcode=1, instance=None, server=None):
         """
         Takes a list of command line arguments, parses it into a command
         name and options, and calls the function corresponding to the command
@@ -882,30 +3292,437 @@ class Baker(object):
         :param helpfile: the file to write usage help to.
         :param errorcode: the exit code to use when calling sys.exit() in the
             case of an error. If this is 0, sys.exit() will not be called.
+        :param server: the socket path of a command server started with
+            serve(). If a server is listening there, the command line is
+            run by the server and this function exits with its exit code.
+
+        If the first argument is ``--baker-batch FILE``, the command lines in
+        FILE are run with run_batch() instead.
+
+        Giving ``--baker-profile`` before the command name runs the command
+        under cProfile and prints the functions that took the most time to
+        'errorfile'. ``--baker-profile=FILE`` saves the statistics to FILE
+        instead, for use with the pstats module.
+
+        ``--baker-sample[=HZ[:FILE]]`` samples the stacks of all threads HZ
+        times per second instead, which slows the command down much less,
+        and writes them in the "collapsed" format used to draw flame graphs.
+
+        ``--baker-mem[=FILE]`` reports the peak memory used by the command
+        and the source lines that allocated the most; see memory().
         """
 
+        if argv is None:
+            argv = sys.argv
+        if server is not None:
+            code = self.forward(server, argv)
+            if code is not None:
+                if main:
+                    sys.exit(code)
+                return code
+        if len(argv) > 1 and argv[1].startswith("--baker-batch"):
+            source = argv[1].partition("=")[2] or "".join(argv[2:3]) or "-"
+            failures = self.run_batch(source, scriptname=argv[0],
+                                      outfile=outfile, errorfile=errorfile,
+                                      helpfile=helpfile, instance=instance)
+            if main and failures and errorcode:
+                sys.exit(errorcode)
+            return failures
+
+        with self.metering() as record:
+            try:
+                scriptname, cmd, args, kwargs = self.parse(argv)
+                record["command"] = cmd.name
+                # Writing the output is included, as that's where the work of
+                # a generator is done
+                with self.profiling(errorfile), self.sampling(errorfile), \
+                        self.memory(cmd, errorfile):
+                    value = self.apply(scriptname, cmd, args, kwargs,
+                                       instance=instance)
+                    started = clock()
+                    failed = False
+                    if main and isinstance(value, MapResults):
+                        failed = self.outputmap(outfile, errorfile, value)
+                    elif main and value is not None:
+                        self.output(outfile, value)
+                    self.timings["output"] = clock() - started
+                    self.fire("after_output", cmd, args, kwargs)
+                if failed and errorcode:
+                    sys.exit(errorcode)
+                return value
+            except TopHelp as e:
+                if not main:
+                    raise
+                self.usage(scriptname=e.scriptname, fobj=helpfile)
+            except CommandHelp as e:
+                if not main:
+                    raise
+                self.usage(e.cmd, scriptname=e.scriptname, fobj=helpfile)
+            except CommandError as e:
+                record["status"] = "command_error"
+                if e.cmd is not None:
+                    record["command"] = e.cmd.name
+                if not main:
+                    raise
+                self.write(errorfile, str(e) + "\n")
+                if help_on_error:
+                    self.write(errorfile, "\n")
+                    self.usage(e.cmd, scriptname=e.scriptname, fobj=helpfile)
+                if errorcode:
+                    sys.exit(errorcode)
+
+    @contextmanager
+    def metering(self, pending=None):
+        """
+        Records the outcome of the body of the with statement in the metrics
+        file given to the constructor, if any. The body can update the
+        record it's given, e.g. with the name of the command. The status of
+        the run is "ok", "command_error" for errors in the command line, or
+        "error" for exceptions and non-zero exit codes.
+
+        :param pending: if given, a list the record is appended to instead
+            of being written, so many records can be written at once with
+            writemetrics().
+        """
+        record = {"command": None, "status": "ok", "exit_code": 0}
+        if not self.metrics:
+            yield record
+            return
+
+        read, written = IO_BYTES["read"], IO_BYTES["written"]
+        record["time"] = time.time()
+        started = clock()
         try:
-            value = self.apply(*self.parse(argv), instance=instance)
-            if main and value is not None:
-                self.write(outfile, str(value) + '\n')
-            return value
-        except TopHelp as e:
-            if not main:
-                raise
-            self.usage(scriptname=e.scriptname, fobj=helpfile)
-        except CommandHelp as e:
-            if not main:
-                raise
-            self.usage(e.cmd, scriptname=e.scriptname, fobj=helpfile)
+            yield record
+        except SystemExit as e:
+            code = e.code
+            if code is not None and not isinstance(code, int):
+                # sys.exit("message") exits with 1
+                code = 1
+            record["exit_code"] = code or 0
+            if code and record["status"] == "ok":
+                record["status"] = "error"
+            raise
+        except (TopHelp, CommandHelp):
+            raise
         except CommandError as e:
-            if not main:
-                raise
-            self.write(errorfile, str(e) + "\n")
-            if help_on_error:
-                self.write(errorfile, "\n")
-                self.usage(e.cmd, scriptname=e.scriptname, fobj=helpfile)
-            if errorcode:
-                sys.exit(errorcode)
+            record["status"] = "command_error"
+            if e.cmd is not None:
+                record["command"] = e.cmd.name
+            record["exit_code"] = 1
+            raise
+        except BaseException:
+            record["status"] = "error"
+            record["exit_code"] = 1
+            raise
+        finally:
+            record["seconds"] = clock() - started
+            record["bytes_read"] = IO_BYTES["read"] - read
+            record["bytes_written"] = IO_BYTES["written"] - written
+            if pending is not None:
+                pending.append(record)
+            else:
+                self.writemetrics([record])
+
+    def writemetrics(self, records):
+        """
+        Writes records made by metering() to the metrics file.
+        """
+        if not self.metrics or not records:
+            return
+        try:
+            if self.metrics.endswith(".prom"):
+                writeprometheus(self.metrics, records)
+            else:
+                writejsonl(self.metrics, records)
+        except (IOError, OSError):
+            # Metrics are never worth failing the command for
+            pass
+
+    def run_batch(self, source, scriptname=None, outfile=sys.stdout,
+                  errorfile=sys.stderr, helpfile=sys.stdout, instance=None):
+        """
+        Runs many command lines in this process, one per line of 'source',
+        which saves starting a new interpreter for each of them. Each line
+        is split like a shell would, and its errors are reported without
+        stopping the batch. Blank lines and lines starting with '#' are
+        skipped. Returns the number of command lines that failed.
+
+        Each line gets its own record in the metrics file, if any. The
+        records are written together at most every OUTPUT_INTERVAL seconds.
+
+        If 'source' is "-" and standard input is a terminal, this works as an
+        interactive prompt, with line editing if readline is available.
+
+        :param source: a file name, "-" for standard input, or an iterable of
+            lines.
+        :param scriptname: the name of the script, defaults to sys.argv[0].
+        :param outfile: the file to write command results to.
+        :param errorfile: the file to write error messages to.
+        :param helpfile: the file to write usage help to.
+        """
+        if scriptname is None:
+            scriptname = sys.argv[0]
+
+        opened = None
+        if source == "-" and sys.stdin.isatty():
+            try:
+                import readline  # enables line editing in input()
+            except ImportError:  # pragma: no cover
+                pass
+            lines = self._prompt("%s> " % os.path.basename(scriptname))
+        elif source == "-":
+            lines = sys.stdin
+        elif isinstance(source, str):
+            lines = opened = open(source)
+        else:
+            lines = source
+
+        total = failures = 0
+        records = []
+        written = clock()
+        try:
+            for lineno, line in enumerate(lines, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                total += 1
+                try:
+                    with self.metering(records) as record:
+                        argv = [scriptname] + shlex.split(line)
+                        parsed = self.parse(argv)
+                        record["command"] = parsed[1].name
+                        value = self.apply(*parsed, instance=instance)
+                        if isinstance(value, MapResults):
+                            if self.outputmap(outfile, errorfile, value):
+                                failures += 1
+                                record["status"] = "error"
+                                record["exit_code"] = 1
+                        elif value is not None:
+                            self.output(outfile, value)
+                except TopHelp as e:
+                    self.usage(scriptname=e.scriptname, fobj=helpfile)
+                except CommandHelp as e:
+                    self.usage(e.cmd, scriptname=e.scriptname, fobj=helpfile)
+                except CommandError as e:
+                    failures += 1
+                    self.write(errorfile, "line %d: %s\n" % (lineno, e))
+                except SystemExit as e:
+                    if e.code == EXIT_SIGPIPE:
+                        # Nobody reads the output of the following lines
+                        raise
+                    if e.code:
+                        failures += 1
+                        self.write(errorfile, "line %d: exited with %s\n"
+                                   % (lineno, e.code))
+                except Exception:
+                    failures += 1
+                    self.write(errorfile, "line %d: %s"
+                               % (lineno, traceback.format_exc()))
+                if records and clock() - written >= OUTPUT_INTERVAL:
+                    self.writemetrics(records)
+                    del records[:]
+                    written = clock()
+        finally:
+            self.writemetrics(records)
+            if opened is not None:
+                opened.close()
+
+        if failures:
+            self.write(errorfile, "%d of %d commands failed\n"
+                       % (failures, total))
+        return failures
+
+    @staticmethod
+    def _prompt(prompt):
+        """
+        Yields lines typed at an interactive prompt until end of file.
+        """
+        while True:
+            try:
+                yield input(prompt)
+            except EOFError:
+                sys.stdout.write("\n")
+                return
+
+    def serve(self, socket_path, workers=4):
+        """
+        Runs a command server on a Unix socket. All the command modules are
+        imported once, then 'workers' processes are forked from this one and
+        serve requests from run(server=socket_path) or forward(), so these
+        don't pay for starting Python and importing modules. The client's
+        arguments, working directory and environment are used for each
+        request, and its output and exit code are sent back to the client.
+        Standard input isn't forwarded.
+
+        This function runs until the process is interrupted or terminated.
+
+        :param socket_path: the path of the Unix socket to listen on.
+        :param workers: the number of worker processes.
+        """
+        import signal
+        import socket
+        for cmd in list(self.commands.values()) + [self.globalcommand]:
+            if cmd is not None:
+                self.load(self.resolve(cmd))
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only the user running the server may connect to it
+        umask = os.umask(0o177)
+        try:
+            listener.bind(socket_path)
+        finally:
+            os.umask(umask)
+        listener.listen(128)
+
+        def terminate(signum, frame):
+            sys.exit(0)
+
+        children = set()
+        oldhandler = signal.signal(signal.SIGTERM, terminate)
+        try:
+            while True:
+                while len(children) < workers:
+                    pid = os.fork()
+                    if pid == 0:
+                        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                        try:
+                            self._worker(listener)
+                        finally:
+                            os._exit(0)
+                    children.add(pid)
+                # Replace workers that exit
+                pid, _ = os.wait()
+                children.discard(pid)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.signal(signal.SIGTERM, oldhandler)
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            listener.close()
+            os.unlink(socket_path)
+
+    def _worker(self, listener):
+        """
+        Serves requests in a forked worker process of serve().
+        """
+        import socket
+        sys.stdin = open(os.devnull)
+        while True:
+            conn, _ = listener.accept()
+            try:
+                self._serve_connection(conn)
+            except socket.error:
+                # The client went away
+                pass
+            finally:
+                conn.close()
+
+    def _serve_connection(self, conn):
+        """
+        Runs the command line sent by a client on the given connection,
+        sending back its output and exit code.
+        """
+        kind, payload = recvframe(conn)
+        if kind != b"r":
+            return
+        request = json.loads(payload.decode("utf-8"))
+        argv = [native(arg) for arg in request["argv"]]
+        environ = dict(os.environ)
+        saved = (os.getcwd(), sys.argv, sys.stdout, sys.stderr,
+                 self.global_options)
+        stdout, stderr = FrameWriter(conn, b"o"), FrameWriter(conn, b"e")
+        try:
+            os.chdir(request["cwd"])
+            os.environ.clear()
+            os.environ.update((native(k), native(v))
+                              for k, v in request["env"].items())
+            sys.argv = argv
+            sys.stdout, sys.stderr = stdout, stderr
+            try:
+                self.run(argv, outfile=stdout, errorfile=stderr,
+                         helpfile=stdout)
+                code = 0
+            except SystemExit as e:
+                code = e.code
+                if code is not None and not isinstance(code, int):
+                    stderr.write("%s\n" % code)
+                    code = 1
+            except Exception:
+                stderr.write(traceback.format_exc())
+                code = 1
+        finally:
+            (cwd, sys.argv, sys.stdout, sys.stderr,
+             self.global_options) = saved
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(environ)
+        sendframe(conn, b"x", str(code or 0).encode("ascii"))
+
+    def forward(self, socket_path, argv=None, outfile=None, errorfile=None):
+        """
+        Sends a command line to a command server started with serve(), and
+        copies its output to stdout and stderr. Returns the exit code of the
+        command, or None if no server is listening on the socket.
+
+        :param socket_path: the path of the server's Unix socket.
+        :param argv: the list of options passed to the command line
+            (sys.argv).
+        """
+        import socket
+        if argv is None:
+            argv = sys.argv
+        if not hasattr(socket, "AF_UNIX"):  # pragma: no cover
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                sock.connect(socket_path)
+            except socket.error:
+                return None
+            self._send_request(sock, argv)
+            return self._read_reply(sock, outfile, errorfile)
+        finally:
+            sock.close()
+
+    @staticmethod
+    def _send_request(sock, argv):
+        request = {"argv": list(argv), "cwd": os.getcwd(),
+                   "env": dict(os.environ)}
+        sendframe(sock, b"r", json.dumps(request).encode("utf-8"))
+
+    @staticmethod
+    def _read_reply(sock, outfile=None, errorfile=None):
+        # Write raw bytes to the standard streams if we can
+        if outfile is None:
+            outfile = getattr(sys.stdout, "buffer", sys.stdout)
+        if errorfile is None:
+            errorfile = getattr(sys.stderr, "buffer", sys.stderr)
+        while True:
+            kind, payload = recvframe(sock)
+            try:
+                if kind == b"o":
+                    outfile.write(payload)
+                    outfile.flush()
+                elif kind == b"e":
+                    errorfile.write(payload)
+                    errorfile.flush()
+            except (IOError, OSError) as e:
+                if e.errno != errno.EPIPE:
+                    raise
+                # Closing the connection stops the command on the server
+                return EXIT_SIGPIPE
+            if kind == b"x":
+                return int(payload)
+            elif kind not in (b"o", b"e"):
+                # The worker died without sending an exit code
+                return 1
 
     def test(self, argv=None, fobj=sys.stdout):
         """
@@ -935,8 +3752,15 @@ class Baker(object):
 
 _baker = Baker()
 command = _baker.command
+lazycommand = _baker.lazycommand
+on = _baker.on
 commands = _baker.commands
 run = _baker.run
+run_batch = _baker.run_batch
+run_many = _baker.run_many
+run_many_async = _baker.run_many_async
+serve = _baker.serve
+forward = _baker.forward
 test = _baker.test
 usage = _baker.usage
 writeconfig = _baker.writeconfig
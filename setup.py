@@ -27,7 +27,6 @@ setup(name="Baker",
                      "Operating System :: OS Independent",
                      "Programming Language :: Python",
                      "Programming Language :: Python :: 2",
-                     "Programming Language :: Python :: 2.6",
                      "Programming Language :: Python :: 2.7",
                      "Programming Language :: Python :: 3",
                      "Programming Language :: Python :: 3.2",
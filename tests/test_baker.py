@@ -1,14 +1,25 @@
+import io
 import os
 import sys
 import bz2
 import gzip
+import heapq
+import json
+import operator
 import shutil
+import signal
 import tempfile
+import threading
+import time
 import unittest
 try:
     from cStringIO import StringIO
 except ImportError:  # pragma: no cover
     from io import BytesIO as StringIO
+try:
+    from concurrent import futures
+except ImportError:  # pragma: no cover
+    futures = None
 
 import baker
 
@@ -81,6 +92,35 @@ Variable arguments:
 """
 
 
+def square(n, offset=0):
+    """Used by the tests that run commands in other processes."""
+    if n == "bad":
+        raise ValueError("bad input")
+    return int(n) ** 2 + offset
+
+
+def add_all(offset, *numbers):
+    """Used by the tests of map_varargs."""
+    return sum(square(n, int(offset)) for n in numbers)
+
+
+def count_lines(lines, pattern=b""):
+    """Used by the tests of split_input."""
+    if not isinstance(pattern, bytes):
+        pattern = pattern.encode()
+    if pattern == b"bad":
+        raise ValueError("bad pattern")
+    return sum(1 for line in lines if pattern in line)
+
+
+def gzip_bytes(data):
+    out = io.BytesIO()
+    fobj = gzip.GzipFile(fileobj=out, mode="wb")
+    fobj.write(data)
+    fobj.close()
+    return out.getvalue()
+
+
 def build_baker():
     b = baker.Baker()
 
@@ -117,6 +157,27 @@ class TestFunctions(unittest.TestCase):
         self.assertEqual(baker.totype("1", baker.Baker()), "1")
         self.assertRaises(TypeError, baker.totype, "invalid", False)
 
+    def test_compile_parser(self):
+        """Test the parse table built when a command is registered"""
+        table = baker.compile_parser(["a", "verbose", "n"],
+                                     {"verbose": False, "n": 2},
+                                     {"verbose": "v", "a": "a"}, False)
+        self.assertEqual(table.shortchars, {"v": "verbose", "a": "a"})
+        self.assertEqual(table.flags, {"verbose": True})
+        self.assertEqual(table.converters["n"]("7"), 7)
+        self.assertEqual(table.slots, (("a", False), ("verbose", True),
+                                       ("n", True)))
+        self.assertTrue(table.has_shortopts)
+
+        b = baker.Baker()
+
+        @b.command(shortopts={"count": "c"})
+        def test(count=1):
+            return count
+
+        self.assertEqual(b.commands["test"].parser.shortchars,
+                         {"c": "count"})
+
     def test_docstrings(self):
         """Test docstring processing"""
         docstring = """This is an example docstring.
@@ -145,17 +206,314 @@ class TestFunctions(unittest.TestCase):
                           "but also how Baker handles blank lines. "
                           ":param yetanother: To make sure the regex is correct."])
 
+    def test_lazy_docs(self):
+        """Test that param docs are only extracted when needed"""
+        b = build_baker()
+        cmd = b.commands["open"]
+        self.assertEqual(cmd[cmd._fields.index("paramdocs")], None)
+        self.assertFalse(hasattr(cmd, "_doccache"))
+        self.assertEqual(sorted(cmd.paramdocs), ["json", "url", "xml"])
+        self.assertTrue(":param" not in cmd.docstring)
+        self.assertTrue(hasattr(cmd, "_doccache"))
+
+        @b.command(params={"a": "Explicit docs"})
+        def explicit(a):
+            """Docstring.
+
+            :param a: Ignored.
+            """
+        cmd = b.commands["explicit"]
+        self.assertEqual(cmd.paramdocs, {"a": "Explicit docs"})
+        self.assertTrue(":param a: Ignored." in cmd.docstring)
+
     def test_openinput(self):
         """Test Baker.openinput()"""
-        self.assertTrue(baker.openinput('-') is sys.stdin)
         tempdir = tempfile.mkdtemp()
-        for ext, opener in [(".gz", gzip.GzipFile), (".bz2", bz2.BZ2File)]:
+        openers = [(".gz", gzip.GzipFile), (".bz2", bz2.BZ2File)]
+        if baker.lzma is not None:
+            openers.append((".xz", baker.lzma.LZMAFile))
+        input = TestBaker.bytes(INPUT_TEST, 'utf-8')
+        for ext, opener in openers:
             g = os.path.join(tempdir, "test" + ext)
-            input = TestBaker.bytes(INPUT_TEST, 'utf-8')
             fobj = opener(g, "w")
             fobj.write(input)
             fobj.close()
             self.assertEqual(baker.openinput(g).read(), input)
+            # The format is detected from the contents, not the name
+            misnamed = os.path.join(tempdir, "misnamed" + ext + ".txt")
+            shutil.copy(g, misnamed)
+            fobj = baker.openinput(misnamed)
+            self.assertEqual(list(fobj), input.splitlines(True))
+            fobj.close()
+            self.assertTrue(getattr(fobj, "fileobj", fobj).closed)
+
+        plain = os.path.join(tempdir, "plain.gz")
+        with open(plain, "wb") as fobj:
+            fobj.write(input)
+        self.assertEqual(baker.openinput(plain, buffering=16).read(), input)
+
+        with baker.openinput(plain, mmap=True) as mapped:
+            self.assertEqual(len(mapped), len(input))
+            self.assertEqual([bytes(line) for line in mapped],
+                             input.splitlines(True))
+            self.assertEqual(bytes(mapped.view[:4]), input[:4])
+            self.assertEqual(mapped.read(), input)
+        empty = os.path.join(tempdir, "empty")
+        open(empty, "w").close()
+        self.assertEqual(list(baker.openinput(empty, mmap=True)), [])
+        self.assertRaises(ValueError, baker.openinput,
+                          os.path.join(tempdir, "test.gz"), mmap=True)
+        self.assertRaises(ValueError, baker.openinput, "-", mmap=True)
+
+        # Reading ahead on a thread gives the same data in small reads
+        fobj = baker.openinput(os.path.join(tempdir, "test.gz"),
+                               buffering=64, prefetch=True)
+        self.assertEqual(list(fobj), input.splitlines(True))
+        self.assertEqual(fobj.read(), b"")
+        fobj.close()
+        self.assertFalse(fobj.raw.thread.is_alive())
+        self.assertTrue(fobj.raw.fileobj.closed)
+        # Closing before the end stops the thread too
+        fobj = baker.openinput(plain, buffering=16, prefetch=True)
+        self.assertEqual(fobj.read(4), input[:4])
+        fobj.close()
+        self.assertFalse(fobj.raw.thread.is_alive())
+
+        class Broken(io.RawIOBase):
+            def readable(self):
+                return True
+
+            def readinto(self, b):
+                raise IOError("broken")
+
+        fobj = io.BufferedReader(baker.PrefetchReader(Broken()))
+        self.assertRaises(IOError, fobj.read)
+        fobj.close()
+
+        # Lines from a pipe are available before a whole chunk is written
+        read, write = os.pipe()
+        fobj = io.BufferedReader(baker.PrefetchReader(io.open(read, "rb")))
+        lines = []
+        reader = threading.Thread(target=lambda: lines.append(fobj.readline()))
+        reader.daemon = True
+        try:
+            os.write(write, b"first\n")
+            reader.start()
+            reader.join(5)
+            self.assertEqual(lines, [b"first\n"])
+            # Closing doesn't wait for a writer that has gone quiet
+            started = time.time()
+            fobj.close()
+            self.assertTrue(time.time() - started < 3)
+            self.assertTrue(fobj.raw.thread.is_alive())
+        finally:
+            os.close(write)
+            reader.join()
+            fobj.close()
+        fobj.raw.thread.join(5)
+        self.assertTrue(fobj.raw.fileobj.closed)
+
+        # Standard input is binary and can be compressed too
+        class Stdin(object):
+            buffer = io.BufferedReader(io.BytesIO(gzip_bytes(input)))
+
+        stdin, sys.stdin = sys.stdin, Stdin()
+        try:
+            fobj = baker.openinput('-')
+            self.assertEqual(fobj.read(), input)
+            fobj.close()
+            self.assertFalse(Stdin.buffer.closed)
+        finally:
+            sys.stdin = stdin
+        shutil.rmtree(tempdir)
+
+    def test_openoutput(self):
+        """Test Baker.openoutput()"""
+        tempdir = tempfile.mkdtemp()
+        output = "".join("line %d\n" % i for i in range(1000)).encode()
+        names = ["plain", "test.gz", "test.bz2"]
+        if baker.lzma is not None:
+            names.append("test.xz")
+        for name in names:
+            for background in (False, True):
+                path = os.path.join(tempdir, name)
+                fobj = baker.openoutput(path, buffering=64,
+                                        background=background)
+                fobj.write(output)
+                # Nothing shows up until the file is closed
+                self.assertFalse(os.path.exists(path))
+                fobj.close()
+                self.assertEqual(baker.openinput(path).read(), output)
+                os.unlink(path)
+        with baker.openoutput(os.path.join(tempdir, "test.gz")) as fobj:
+            fobj.write(output)
+        with open(os.path.join(tempdir, "test.gz"), "rb") as fobj:
+            self.assertEqual(fobj.read(2), b"\x1f\x8b")
+
+        # The permissions follow the umask in force
+        umask = os.umask(0o027)
+        try:
+            path = os.path.join(tempdir, "mode")
+            baker.openoutput(path).close()
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+            os.umask(0o077)
+            baker.openoutput(path).close()
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        finally:
+            os.umask(umask)
+
+        # Failures leave the existing file alone
+        path = os.path.join(tempdir, "plain")
+        with open(path, "wb") as fobj:
+            fobj.write(b"old")
+        try:
+            with baker.openoutput(path) as fobj:
+                fobj.write(b"new")
+                raise ValueError
+        except ValueError:
+            pass
+        fobj = baker.openoutput(path, background=True)
+        fobj.write(b"new")
+        fobj.discard()
+        with open(path, "rb") as fobj:
+            self.assertEqual(fobj.read(), b"old")
+        self.assertEqual(sorted(os.listdir(tempdir)),
+                         ["mode", "plain", "test.gz"])
+
+        class Broken(io.RawIOBase):
+            def writable(self):
+                return True
+
+            def write(self, b):
+                raise IOError("broken")
+
+        fobj = io.BufferedWriter(baker.BackgroundWriter(Broken()))
+        fobj.write(b"data")
+        self.assertRaises(IOError, fobj.close)
+
+        class Stdout(object):
+            buffer = io.BytesIO()
+
+            def flush(self):
+                pass
+
+        stdout, sys.stdout = sys.stdout, Stdout()
+        try:
+            with baker.openoutput('-') as fobj:
+                fobj.write(output)
+            self.assertEqual(Stdout.buffer.getvalue(), output)
+            self.assertFalse(Stdout.buffer.closed)
+        finally:
+            sys.stdout = stdout
+        shutil.rmtree(tempdir)
+
+
+    def test_files(self):
+        """Test file parameters of commands"""
+        tempdir = tempfile.mkdtemp()
+        paths = []
+        for i in range(3):
+            paths.append(os.path.join(tempdir, "in%d.gz" % i))
+            with baker.openoutput(paths[-1]) as fobj:
+                fobj.write(("%d\n%d\n" % (i, i * 10)).encode())
+        b = baker.Baker()
+        seen = []
+
+        @b.command(files={"dst": "w", "srcs": "r"}, prefetch=True)
+        def merge(dst, *srcs):
+            for src in srcs:
+                # Only the file being read is open
+                seen.append([f.fileobj is not None for f in srcs])
+                for line in src:
+                    dst.write(line)
+            return dst.name
+
+        @b.command(files={"src": "r", "dst": "w"})
+        def copy(src, dst="-", fail=False):
+            dst.write(src.read())
+            if fail:
+                raise ValueError
+            return src
+
+        @b.command(files={"src": "r"})
+        def count(src, unused=None):
+            return len(src.readlines())
+
+        out = os.path.join(tempdir, "out.bz2")
+        self.assertEqual(b.run(["s", "merge", out] + paths, main=False), out)
+        self.assertEqual(seen, [[False] * 3] * 3)
+        self.assertEqual(baker.openinput(out).read(), b"0\n0\n1\n10\n2\n20\n")
+
+        src = b.run(["s", "copy", paths[1], "--dst", out], main=False)
+        self.assertTrue(isinstance(src, baker.LazyFile))
+        self.assertTrue(src.closed)
+        self.assertEqual(baker.openinput(out).read(), b"1\n10\n")
+        self.assertRaises(ValueError, b.run,
+                          ["s", "copy", paths[0], out, "--fail"], main=False)
+        self.assertEqual(baker.openinput(out).read(), b"1\n10\n")
+        self.assertEqual(b.run(["s", "count", paths[2]], main=False), 2)
+
+        # The default of a file parameter is opened too
+        class Stdout(object):
+            buffer = io.BytesIO()
+
+            def flush(self):
+                pass
+
+        stdout, sys.stdout = sys.stdout, Stdout()
+        try:
+            b.run(["s", "copy", paths[2]], main=False)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(Stdout.buffer.getvalue(), b"2\n20\n")
+
+        # A merge of more files than may be open at once
+        for i, path in enumerate(paths):
+            with baker.openoutput(path) as fobj:
+                fobj.write("".join("%03d\n" % n
+                                   for n in range(i, 60, 3)).encode())
+
+        @b.command(files={"srcs": "r"}, maxopen=2)
+        def kmerge(*srcs):
+            merged = list(heapq.merge(*srcs))
+            return merged, srcs[0].pool
+
+        merged, pool = b.run(["s", "kmerge"] + paths, main=False)
+        self.assertEqual(merged, [("%03d\n" % n).encode() for n in range(60)])
+        self.assertTrue(pool.reopens > 0)
+        self.assertTrue(pool.hits > 0)
+        self.assertEqual(len(pool.lru), 0)
+
+        pool = baker.FilePool(1)
+        first, second = pool.open(paths[0]), pool.open(paths[1])
+        self.assertEqual(first.readline(), b"000\n")
+        self.assertEqual(second.readline(), b"001\n")
+        self.assertEqual(first.readline(), b"003\n")
+        self.assertEqual(first.tell(), 8)
+        self.assertEqual((pool.hits, pool.reopens), (1, 1))
+        self.assertEqual(len(list(second)), 19)
+        self.assertTrue(second.closed)
+        self.assertRaises(ValueError, second.read)
+        pool.close()
+        self.assertEqual(len(pool.lru), 0)
+        self.assertRaises(ValueError, baker.FilePool, 0)
+
+        self.assertRaises(baker.CommandError, b.command,
+                          lambda src: src, files={"dst": "w"})
+        self.assertRaises(baker.CommandError, b.command,
+                          lambda src: src, files={"src": "rw"})
+        shutil.rmtree(tempdir)
+
+    def test_lazy_imports(self):
+        import subprocess
+        code = ("import sys, baker\n"
+                "heavy = ['asyncio', 'concurrent.futures', 'pickle', 'socket',"
+                " 'tempfile']\n"
+                "print(' '.join(m for m in heavy if m in sys.modules))\n")
+        here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, "-c", code],
+                                         cwd=here)
+        self.assertEqual(output.strip(), b"")
 
 
 class TestBaker(unittest.TestCase):
@@ -389,6 +747,32 @@ class TestBaker(unittest.TestCase):
         self.assertRaises(ce, br, ["s", "test", "-b", "1", "--c", "2"],
                           main=False)
 
+    def test_large_argv(self):
+        """Test that parsing scales linearly and leaves argv untouched"""
+        b = baker.Baker()
+
+        @b.command
+        def test(out, verbose=False, *paths):
+            return out, verbose, len(paths)
+
+        def timed(n):
+            argv = ["s", "test", "--verbose", "o"] + ["p"] * n
+            start = time.time()
+            self.assertEqual(b.run(argv, main=False), ("o", True, n))
+            self.assertEqual(len(argv), n + 4)
+            return time.time() - start
+
+        small, large = timed(10 ** 5), timed(10 ** 6)
+        # A quadratic parser would take ~100 times longer for 10 times as
+        # many arguments
+        self.assertTrue(large < max(small, 0.01) * 40)
+
+        options = ["--verbose", "a", "b"]
+        _, cmd, args, kwargs = b.parse(["s", "test"] + options)
+        self.assertEqual(options, ["--verbose", "a", "b"])
+        self.assertEqual(b.apply("s", cmd, args, kwargs), ("a", True, 1))
+        self.assertEqual(args, ["a", "b"])
+
     def test_boolean_arg_and_args(self):
         """Test boolean arguments and *args"""
         b = baker.Baker()
@@ -497,6 +881,773 @@ class TestBaker(unittest.TestCase):
         self.assertEqual(b.global_options, {"num": -1, "val": False, "index":
                                             "http://pypi.python.org/pypi"})
 
+    def test_lazycommand(self):
+        """Test commands registered by import path"""
+        tempdir = tempfile.mkdtemp()
+        with open(os.path.join(tempdir, "baker_lazy_mod.py"), "w") as fobj:
+            fobj.write('def scale(value, factor=2):\n'
+                       '    """Scales a value.\n\n'
+                       '    :param value: the value.\n'
+                       '    """\n'
+                       '    return int(value) * factor\n')
+        sys.path.insert(0, tempdir)
+        try:
+            b = baker.Baker()
+            b.lazycommand("baker_lazy_mod:scale", "scale", "Scales a value.")
+            out = StringIO()
+            b.usage(scriptname="s", fobj=out)
+            self.assertTrue(self.bytes(" scale  Scales a value.", "utf-8")
+                            in out.getvalue())
+            self.assertFalse("baker_lazy_mod" in sys.modules)
+
+            self.assertEqual(b.run(["s", "scale", "3", "--factor", "5"],
+                                   main=False), 15)
+            self.assertTrue("baker_lazy_mod" in sys.modules)
+            cmd = b.commands["scale"]
+            self.assertEqual(cmd.argnames, ["value", "factor"])
+            self.assertEqual(cmd.paramdocs, {"value": "the value.\n"})
+        finally:
+            sys.path.remove(tempdir)
+            sys.modules.pop("baker_lazy_mod", None)
+            shutil.rmtree(tempdir)
+
+    def test_lazycommand_registered(self):
+        """Test lazy commands whose module registers them itself"""
+        tempdir = tempfile.mkdtemp()
+        with open(os.path.join(tempdir, "baker_lazy_app.py"), "w") as fobj:
+            fobj.write('import baker\n'
+                       'b = baker.Baker()\n'
+                       'b.lazycommand("baker_lazy_cmds:scale", "sc")\n')
+        with open(os.path.join(tempdir, "baker_lazy_cmds.py"), "w") as fobj:
+            fobj.write('from baker_lazy_app import b\n'
+                       '@b.command(shortopts={"factor": "f"})\n'
+                       'def scale(value, factor=2):\n'
+                       '    return int(value) * int(factor)\n')
+        sys.path.insert(0, tempdir)
+        try:
+            from baker_lazy_app import b
+            self.assertEqual(b.run(["s", "sc", "3", "-f", "5"], main=False),
+                             15)
+            self.assertEqual(sorted(b.commands), ["sc"])
+            cmd = b.commands["sc"]
+            self.assertEqual(cmd.name, "sc")
+            self.assertEqual(cmd.shortopts, {"factor": "f"})
+            self.assertTrue(cmd.fn is sys.modules["baker_lazy_cmds"].scale)
+        finally:
+            sys.path.remove(tempdir)
+            sys.modules.pop("baker_lazy_app", None)
+            sys.modules.pop("baker_lazy_cmds", None)
+            shutil.rmtree(tempdir)
+
+    def test_manifest(self):
+        """Test writing and reading a command manifest"""
+        tempdir = tempfile.mkdtemp()
+        modpath = os.path.join(tempdir, "baker_manifest_mod.py")
+        with open(modpath, "w") as fobj:
+            fobj.write('def scale(value, factor=2, *more):\n'
+                       '    """Scales a value.\n\n'
+                       '    :param factor: the factor.\n'
+                       '    """\n'
+                       '    return int(value) * factor\n'
+                       'def total(lines, start=(0, 0.5)):\n'
+                       '    return sum(map(int, lines))\n')
+        manifest = os.path.join(tempdir, "manifest")
+        sys.path.insert(0, tempdir)
+        try:
+            import baker_manifest_mod
+            b = baker.Baker()
+            b.command(baker_manifest_mod.scale, shortopts={"factor": "f"})
+            b.command(baker_manifest_mod.total, split_input="lines",
+                      reducer=operator.add)
+            b.writemanifest(manifest)
+            del sys.modules["baker_manifest_mod"]
+            with open(manifest) as fobj:
+                self.assertEqual(json.load(fobj)["version"],
+                                 baker.MANIFEST_VERSION)
+
+            b = baker.Baker()
+            self.assertTrue(b.readmanifest(manifest))
+            out = StringIO()
+            b.usage("scale", scriptname="s", fobj=out)
+            self.assertTrue(self.bytes("-f --factor  the factor.", "utf-8")
+                            in out.getvalue())
+            self.assertRaises(baker.CommandError, b.run,
+                              ["s", "scale", "1", "-f", "x"], main=False)
+            self.assertFalse("baker_manifest_mod" in sys.modules)
+            self.assertEqual(b.run(["s", "scale", "3", "-f", "5"],
+                                   main=False), 15)
+            self.assertTrue("baker_manifest_mod" in sys.modules)
+            total = b.commands["total"]
+            self.assertEqual(total.keywords, {"start": (0, 0.5)})
+            self.assertEqual(total.options["reducer"](2, 3), 5)
+
+            # run_many_async() imports the module in this process too
+            if sys.version_info >= (3, 4):
+                del sys.modules["baker_manifest_mod"]
+                b = baker.Baker()
+                self.assertTrue(b.readmanifest(manifest))
+                imported = []
+                b.on("after_import",
+                     lambda cmd, *rest: imported.append(cmd.name))
+                results = list(b.run_many_async([["s", "scale", "3"]]))
+                self.assertEqual([r.value for r in results], [6])
+                self.assertEqual(imported, ["scale"])
+                self.assertTrue("import" in b.timings)
+
+            with open(modpath, "a") as fobj:
+                fobj.write("# changed\n")
+            self.assertFalse(baker.Baker().readmanifest(manifest))
+            self.assertFalse(baker.Baker().readmanifest(modpath + ".none"))
+
+            # Reducers must be importable and defaults literals
+            b = baker.Baker()
+            b.command(baker_manifest_mod.total, split_input="lines",
+                      reducer=lambda a, b: a + b)
+            self.assertRaises(ValueError, b.writemanifest, manifest)
+            b = baker.Baker()
+            baker_manifest_mod.total.__defaults__ = (object(),)
+            b.command(baker_manifest_mod.total)
+            self.assertRaises(ValueError, b.writemanifest, manifest)
+
+            @b.command
+            def local():
+                pass
+            self.assertRaises(ValueError, b.writemanifest, manifest)
+        finally:
+            sys.path.remove(tempdir)
+            sys.modules.pop("baker_manifest_mod", None)
+            shutil.rmtree(tempdir)
+
+    def test_run_batch(self):
+        """Test running many command lines in one process"""
+        b = baker.Baker()
+
+        @b.command
+        def add(a, b=1):
+            return int(a) + int(b)
+
+        @b.command
+        def fail():
+            raise ValueError("broken")
+
+        out, err = StringIO(), StringIO()
+        lines = ["add 1", "# comment", "", "add 2 --b 'not a number'",
+                 "fail", "add 2 -b 5", "nosuchcommand"]
+        self.assertEqual(b.run_batch(lines, scriptname="s", outfile=out,
+                                     errorfile=err), 3)
+        self.assertEqual(out.getvalue(), "2\n7\n")
+        errors = err.getvalue()
+        if not isinstance(errors, str):
+            errors = errors.decode("utf-8")
+        self.assertTrue("line 4: " in errors)
+        self.assertTrue("line 5: Traceback" in errors)
+        self.assertTrue("ValueError: broken" in errors)
+        self.assertTrue("line 7: No command specified" in errors)
+        self.assertTrue("3 of 5 commands failed" in errors)
+
+        # Reading "-" through a file parameter leaves the standard input
+        # the batch comes from open
+        import subprocess
+        code = ("import sys, baker\n"
+                "b = baker.Baker()\n"
+                "@b.command(files={'src': 'r'})\n"
+                "def size(src):\n"
+                "    return len(src.read())\n"
+                "failures = b.run_batch('-')\n"
+                "baker.openinput('-', prefetch=True).close()\n"
+                "print(getattr(sys.stdin, 'buffer', sys.stdin).closed)\n"
+                "sys.exit(failures)\n")
+        here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        proc = subprocess.Popen([sys.executable, "-c", code], cwd=here,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        output, errors = proc.communicate(b"size -\nsize -\n")
+        self.assertTrue(proc.returncode == 0, errors)
+        self.assertEqual(output.split(), [b"0", b"0", b"False"])
+
+        tempdir = tempfile.mkdtemp()
+        batch = os.path.join(tempdir, "batch.txt")
+        with open(batch, "w") as fobj:
+            fobj.write("add 1 2\nadd 3\n")
+        out = StringIO()
+        self.assertEqual(b.run(["s", "--baker-batch", batch], outfile=out),
+                         0)
+        self.assertEqual(out.getvalue(), "3\n4\n")
+        shutil.rmtree(tempdir)
+
+    @unittest.skipIf(not hasattr(os, "fork"), "requires os.fork")
+    def test_serve(self):
+        """Test forwarding command lines to a command server"""
+        b = baker.Baker()
+
+        @b.command
+        def where(name, loud=False):
+            sys.stdout.write("hello %s\n" % name)
+            return os.getcwd(), os.environ.get("BAKER_TEST_VAR"), loud
+
+        @b.command
+        def crash():
+            raise ValueError("crashed")
+
+        tempdir = os.path.realpath(tempfile.mkdtemp())
+        path = os.path.join(tempdir, "sock")
+        self.assertEqual(b.forward(path, ["s", "where", "x"]), None)
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                b.serve(path, workers=2)
+            finally:
+                os._exit(0)
+        try:
+            for _ in range(500):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.01)
+            cwd = os.getcwd()
+            os.chdir(tempdir)
+            os.environ["BAKER_TEST_VAR"] = "forwarded"
+            try:
+                out, err = StringIO(), StringIO()
+                self.assertEqual(b.forward(path, ["s", "where", "x", "--loud"],
+                                           outfile=out, errorfile=err), 0)
+                self.assertEqual(out.getvalue(),
+                                 "hello x\n%r\n" % ((tempdir, "forwarded",
+                                                     True),))
+                out, err = StringIO(), StringIO()
+                self.assertEqual(b.forward(path, ["s", "crash"],
+                                           outfile=out, errorfile=err), 1)
+                self.assertTrue(b"ValueError: crashed" in err.getvalue())
+                self.assertEqual(b.forward(path, ["s", "nosuchcommand"],
+                                           outfile=out, errorfile=err), 1)
+            finally:
+                os.chdir(cwd)
+                del os.environ["BAKER_TEST_VAR"]
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+            shutil.rmtree(tempdir)
+
+    @unittest.skipIf(futures is None, "requires concurrent.futures")
+    def test_run_many(self):
+        """Test running many command lines in a process pool"""
+        b = baker.Baker()
+        b.command(square)
+        argvs = [["s", "square", str(n), "--offset", "1"] for n in range(20)]
+        argvs.append(["s", "square", "bad"])
+
+        results = list(b.run_many(argvs, workers=2))
+        self.assertEqual([r.item for r in results], argvs)
+        self.assertEqual([r.value for r in results[:-1]],
+                         [n ** 2 + 1 for n in range(20)])
+        self.assertTrue(all(r.elapsed >= 0 for r in results))
+        self.assertTrue(isinstance(results[-1].exception, ValueError))
+
+        results = list(b.run_many(argvs[:5], workers=2, ordered=False))
+        self.assertEqual(sorted(r.value for r in results), [1, 2, 5, 10, 17])
+
+        self.assertRaises(baker.CommandError, b.run_many,
+                          argvs + [["s", "square", "1", "--offset", "x"]])
+
+        # Commands that need call() to open their files are rejected
+        b.command(lambda src: src.read(), name="cat", files={"src": "r"})
+        self.assertRaises(baker.CommandError, b.run_many,
+                          [["s", "cat", "/dev/null"]])
+        self.assertRaises(baker.CommandError, b.run_many_async,
+                          [["s", "cat", "/dev/null"]])
+
+    def test_output_stream(self):
+        """Test writing the items of generators one per line"""
+        b = baker.Baker()
+        done = []
+
+        @b.command
+        def numbers(n):
+            try:
+                for i in range(int(n)):
+                    yield i
+            finally:
+                done.append(n)
+
+        @b.command
+        def listed():
+            return [1, 2]
+
+        out = StringIO()
+        b.run(["s", "numbers", "100000"], outfile=out)
+        self.assertEqual(out.getvalue(),
+                         "".join("%d\n" % i for i in range(100000)))
+        self.assertEqual(done, ["100000"])
+        out = StringIO()
+        b.run(["s", "listed"], outfile=out)
+        self.assertEqual(out.getvalue(), "[1, 2]\n")
+
+        # Values that aren't iterators aren't closed, and the output file
+        # needn't have a flush() method
+        class Closable(object):
+            closed = False
+
+            def __str__(self):
+                return "closable"
+
+            def close(self):
+                self.closed = True
+
+        class Unflushable(object):
+            def __init__(self):
+                self.written = []
+
+            def write(self, text):
+                self.written.append(text)
+
+        value = Closable()
+        out = Unflushable()
+        b.output(out, value)
+        self.assertEqual(out.written, ["closable\n"])
+        self.assertFalse(value.closed)
+        b.output(out, iter([1, 2]))
+        self.assertEqual(out.written[1:], ["1\n2\n"])
+
+        # A closed pipe stops the generator, and later output is thrown
+        # away
+        def closedpipe():
+            read, write = os.pipe()
+            os.close(read)
+            return os.fdopen(write, "w")
+
+        outfile = closedpipe()
+        try:
+            try:
+                b.run(["s", "numbers", "1000000"], outfile=outfile)
+            except SystemExit as e:
+                self.assertEqual(e.code, 141)
+            else:
+                self.fail("Expected SystemExit")
+            self.assertEqual(done[-1], "1000000")
+            b.run(["s", "numbers", "10"], outfile=outfile)
+        finally:
+            outfile.close()
+        outfile = closedpipe()
+        try:
+            self.assertRaises(SystemExit, b.run_batch,
+                              ["numbers 10", "numbers 11"], outfile=outfile)
+            self.assertEqual(done[-1], "10")
+        finally:
+            outfile.close()
+
+        # Files stay open until the generator is done
+        tempdir = tempfile.mkdtemp()
+        src, dst = os.path.join(tempdir, "src"), os.path.join(tempdir, "dst")
+        with open(src, "wb") as fobj:
+            fobj.write(b"a\nb\n")
+
+        @b.command(files={"src": "r", "dst": "w"})
+        def copy(src, dst):
+            for line in src:
+                dst.write(line)
+                yield len(line)
+
+        out = StringIO()
+        b.run(["s", "copy", src, dst], outfile=out)
+        self.assertEqual(out.getvalue(), "2\n2\n")
+        with open(dst, "rb") as fobj:
+            self.assertEqual(fobj.read(), b"a\nb\n")
+        shutil.rmtree(tempdir)
+
+    def test_hooks(self):
+        """Test callbacks for the phases of running a command"""
+        tempdir = tempfile.mkdtemp()
+        with open(os.path.join(tempdir, "baker_hook_mod.py"), "w") as fobj:
+            fobj.write("def slow(n):\n"
+                       "    return n * 2\n")
+        sys.path.insert(0, tempdir)
+        try:
+            b = baker.Baker()
+            events = []
+
+            @b.command(global_command=True)
+            def setup(verbose=False):
+                return {"verbose": verbose}
+
+            b.lazycommand("baker_hook_mod:slow", "slow")
+
+            def hook(event):
+                def callback(cmd, args, kwargs, timings):
+                    events.append((event, cmd.name, args, sorted(timings)))
+                return callback
+
+            for event in baker.HOOK_EVENTS:
+                b.on(event, hook(event))
+
+            @b.on("after_output")
+            def check(cmd, args, kwargs, timings):
+                self.assertTrue(all(t >= 0 for t in timings.values()))
+
+            out = StringIO()
+            b.run(["s", "--verbose", "slow", "ab"], outfile=out)
+            self.assertEqual(out.getvalue(), "abab\n")
+        finally:
+            sys.path.remove(tempdir)
+            sys.modules.pop("baker_hook_mod", None)
+            shutil.rmtree(tempdir)
+
+        self.assertEqual(events, [
+            ("after_global_apply", "setup", [], ["global_apply"]),
+            ("after_import", "slow", None, ["global_apply", "import"]),
+            ("after_parse", "slow", ["ab"],
+             ["global_apply", "import", "parse"]),
+            ("after_apply", "slow", ["ab"],
+             ["apply", "global_apply", "import", "parse"]),
+            ("after_output", "slow", ["ab"],
+             ["apply", "global_apply", "import", "output", "parse"]),
+        ])
+        self.assertRaises(ValueError, b.on, "before_everything")
+
+    def test_metrics(self):
+        """Test recording the outcome of every run"""
+        tempdir = tempfile.mkdtemp()
+        src = os.path.join(tempdir, "src")
+        with open(src, "wb") as fobj:
+            fobj.write(b"x" * 1000)
+
+        def build(metrics):
+            b = baker.Baker(metrics=metrics)
+
+            @b.command(files={"src": "r", "dst": "w"})
+            def copy(src, dst):
+                dst.write(src.read())
+
+            @b.command
+            def fail():
+                raise ValueError
+
+            return b
+
+        path = os.path.join(tempdir, "metrics.jsonl")
+        b = build(path)
+        b.run(["s", "copy", src, os.path.join(tempdir, "dst.gz")])
+        self.assertRaises(ValueError, b.run, ["s", "fail"])
+        self.assertRaises(SystemExit, b.run, ["s", "copy"],
+                          errorfile=StringIO())
+        b.run(["s", "--help"], helpfile=StringIO())
+        with open(path) as fobj:
+            records = [json.loads(line) for line in fobj]
+        self.assertEqual([(r["command"], r["status"], r["exit_code"])
+                          for r in records],
+                         [("copy", "ok", 0), ("fail", "error", 1),
+                          ("copy", "command_error", 1), (None, "ok", 0)])
+        self.assertEqual(records[0]["bytes_read"], 1000)
+        self.assertTrue(0 < records[0]["bytes_written"] < 1000)
+        self.assertTrue(records[0]["seconds"] >= 0)
+
+        # Every line of a batch gets a record
+        os.remove(path)
+        b.run_batch(["copy %s %s" % (src, os.path.join(tempdir, "dst")),
+                     "fail", "copy", "--help", "missing"],
+                    errorfile=StringIO(), helpfile=StringIO())
+        with open(path) as fobj:
+            records = [json.loads(line) for line in fobj]
+        self.assertEqual([(r["command"], r["status"], r["exit_code"])
+                          for r in records],
+                         [("copy", "ok", 0), ("fail", "error", 1),
+                          ("copy", "command_error", 1), (None, "ok", 0),
+                          (None, "command_error", 1)])
+        self.assertEqual(records[0]["bytes_read"], 1000)
+
+        path = os.path.join(tempdir, "baker.prom")
+        b = build(path)
+        for _ in range(2):
+            b.run(["s", "copy", src, os.path.join(tempdir, "dst")])
+        self.assertRaises(ValueError, b.run, ["s", "fail"])
+        with open(path) as fobj:
+            text = fobj.read()
+        self.assertTrue("# TYPE baker_runs_total counter\n" in text)
+        self.assertTrue('baker_runs_total{command="copy",status="ok"} 2.0\n'
+                        in text)
+        self.assertTrue('baker_runs_total{command="fail",status="error"} 1.0'
+                        in text)
+        self.assertTrue('baker_bytes_read_total{command="copy"} 2000.0\n'
+                        in text)
+        self.assertTrue('baker_bytes_written_total{command="copy"} 2000.0\n'
+                        in text)
+        self.assertTrue('baker_last_exit_code{command="fail"} 1.0\n' in text)
+        shutil.rmtree(tempdir)
+
+    def test_profile(self):
+        """Test the --baker-profile option"""
+        b = baker.Baker()
+
+        @b.command
+        def work(n, baker_profile=False):
+            return sum(range(int(n))), baker_profile
+
+        out, err = StringIO(), StringIO()
+        b.run(["s", "--baker-profile", "work", "1000"], outfile=out,
+              errorfile=err)
+        self.assertEqual(out.getvalue(), "(499500, False)\n")
+        self.assertTrue(self.bytes("cumulative", "utf-8") in err.getvalue())
+        self.assertEqual(b.reserved, {"baker-profile": True})
+
+        tempdir = tempfile.mkdtemp()
+        path = os.path.join(tempdir, "work.prof")
+        err = StringIO()
+        b.run(["s", "--baker-profile=" + path, "work", "10"],
+              outfile=StringIO(), errorfile=err)
+        self.assertEqual(err.getvalue(), self.bytes("", "utf-8"))
+        import pstats
+        self.assertTrue(pstats.Stats(path).total_calls > 0)
+        shutil.rmtree(tempdir)
+
+        # After the command name, options belong to the command
+        self.assertEqual(b.run(["s", "work", "10", "--baker_profile"],
+                               main=False), (45, True))
+        self.assertRaises(baker.CommandError, b.run,
+                          ["s", "work", "10", "--baker-profile"], main=False)
+        self.assertEqual(b.reserved, {})
+
+    def test_mem(self):
+        """Test the --baker-mem option"""
+        b = baker.Baker()
+        kept = []
+
+        @b.command
+        def allocate(n):
+            blocks = [bytearray(1000) for _ in range(int(n))]
+            kept.append(blocks)
+            return len(blocks)
+
+        tempdir = tempfile.mkdtemp()
+        path = os.path.join(tempdir, "mem.json")
+        b.run(["s", "--baker-mem=" + path, "allocate", "5000"],
+              outfile=StringIO())
+        with open(path) as fobj:
+            report = json.load(fobj)
+        shutil.rmtree(tempdir)
+        self.assertEqual(report["command"], "allocate")
+        if report["maxrss_after"] is not None:
+            self.assertTrue(report["maxrss_after"] >= report["maxrss_before"])
+        if sys.version_info >= (3, 4):
+            self.assertTrue(report["peak"] > 5000 * 1000)
+            self.assertTrue(len(report["lines"]) <= b.mem_limit)
+            # The line of the command holding the memory comes first
+            top = report["lines"][0]
+            self.assertEqual(os.path.basename(top["file"]), "test_baker.py")
+            source, first = baker.inspect.getsourcelines(allocate)
+            self.assertTrue("bytearray" in source[top["line"] - first])
+            self.assertTrue(top["size"] >= 5000 * 1000)
+            self.assertFalse(any("importlib" in entry["file"]
+                                 for entry in report["lines"]))
+        else:
+            self.assertEqual(report["peak"], None)
+
+        err = StringIO()
+        b.run(["s", "--baker-mem", "allocate", "10"], outfile=StringIO(),
+              errorfile=err)
+        self.assertTrue(self.bytes("Memory used by 'allocate'", "utf-8")
+                        in err.getvalue())
+
+    def test_sample(self):
+        """Test the --baker-sample option"""
+        b = baker.Baker()
+
+        @b.command
+        def spin(seconds):
+            end = time.time() + float(seconds)
+            while time.time() < end:
+                pass
+
+        tempdir = tempfile.mkdtemp()
+        path = os.path.join(tempdir, "spin.folded")
+        b.run(["s", "--baker-sample=500:" + path, "spin", "0.2"])
+        with open(path) as fobj:
+            lines = fobj.read().splitlines()
+        self.assertTrue(lines)
+        stacks = [line.rsplit(" ", 1)[0] for line in lines]
+        self.assertTrue(sum(int(line.rsplit(" ", 1)[1]) for line in lines)
+                        > 10)
+        self.assertTrue(any(stack.startswith("MainThread;") and
+                            stack.endswith(";spin (%s:%d)" % (
+                                spin.__code__.co_filename,
+                                spin.__code__.co_firstlineno))
+                            for stack in stacks))
+        self.assertFalse(any("baker-sampler" in stack for stack in stacks))
+        shutil.rmtree(tempdir)
+
+        err = StringIO()
+        b.run(["s", "--baker-sample", "spin", "0.05"], errorfile=err)
+        self.assertTrue(self.bytes("MainThread;", "utf-8") in err.getvalue())
+        self.assertRaises(baker.CommandError, b.run,
+                          ["s", "--baker-sample=fast", "spin", "0"],
+                          main=False)
+
+    @unittest.skipIf(futures is None, "requires concurrent.futures")
+    def test_map_varargs(self):
+        """Test calling a command for each of its varargs in a pool"""
+        b = baker.Baker()
+        b.command(add_all, map_varargs=True, executor="process", workers=2)
+        names = []
+
+        @b.command(map_varargs=True, workers=4)
+        def fetch(prefix, *paths):
+            names.append(threading.current_thread().name)
+            if paths[0] == "missing":
+                raise IOError("no such path")
+            time.sleep(0.01 * len(paths[0]))
+            return prefix + paths[0]
+
+        results = b.run(["s", "fetch", "/", "aaa", "a", "missing", "aa"],
+                        main=False)
+        self.assertTrue(isinstance(results, baker.MapResults))
+        results = list(results)
+        self.assertEqual([r.item for r in results],
+                         ["aaa", "a", "missing", "aa"])
+        self.assertEqual([r.value for r in results],
+                         ["/aaa", "/a", None, "/aa"])
+        self.assertTrue(isinstance(results[2].exception, IOError))
+        self.assertTrue(all(name.startswith("baker-map") for name in names)
+                        or sys.version_info < (3, 6))
+
+        results = list(b.run(["s", "add_all", "1", "2", "bad", "3"],
+                             main=False))
+        self.assertEqual([r.value for r in results], [5, None, 10])
+        self.assertTrue(isinstance(results[1].exception, ValueError))
+
+        out, err = StringIO(), StringIO()
+        self.assertRaises(SystemExit, b.run,
+                          ["s", "fetch", "-", "x", "missing", "y"],
+                          outfile=out, errorfile=err)
+        self.assertEqual(out.getvalue(), "-x\n-y\n")
+        errors = err.getvalue()
+        if not isinstance(errors, str):
+            errors = errors.decode("utf-8")
+        self.assertTrue("missing: " in errors)
+        self.assertTrue("1 of 3 items failed" in errors)
+        out = StringIO()
+        b.run(["s", "fetch", "-", "x"], outfile=out)
+        self.assertEqual(out.getvalue(), "-x\n")
+
+        # A closed pipe stops the pool like it stops a generator
+        called = []
+
+        @b.command(map_varargs=True, workers=2)
+        def repeat(*items):
+            called.append(items[0])
+            time.sleep(0.001)
+            return items[0] * 100000
+
+        read, write = os.pipe()
+        os.close(read)
+        outfile = os.fdopen(write, "w")
+        try:
+            try:
+                b.run(["s", "repeat"] + ["x"] * 1000, outfile=outfile)
+            except SystemExit as e:
+                self.assertEqual(e.code, 141)
+            else:
+                self.fail("Expected SystemExit")
+            self.assertTrue(len(called) < 1000)
+        finally:
+            outfile.close()
+
+        self.assertRaises(baker.CommandError, b.command, square,
+                          map_varargs=True)
+        self.assertRaises(baker.CommandError, b.command, add_all,
+                          map_varargs=True, executor="fork")
+
+    @unittest.skipIf(futures is None, "requires concurrent.futures")
+    def test_split_input(self):
+        """Test processing parts of one input file in parallel"""
+        tempdir = tempfile.mkdtemp()
+        path = os.path.join(tempdir, "big")
+        lines = ["line %d%s\n" % (i, " x" * (i % 7)) for i in range(2000)]
+        data = "".join(lines).encode()
+        with open(path, "wb") as fobj:
+            fobj.write(data)
+
+        for parts in (1, 3, 16, 5000):
+            chunks = baker.linechunks(path, parts)
+            self.assertEqual(chunks[0][0], 0)
+            self.assertEqual(chunks[-1][1], len(data))
+            joined = b""
+            for start, end in chunks:
+                self.assertTrue(start == 0 or data[start - 1:start] == b"\n")
+                joined += b"".join(baker.InputChunk(path, start, end))
+            self.assertEqual(joined, data)
+        blocks = list(baker.lineblocks(io.BytesIO(data), 100))
+        self.assertEqual(b"".join(blocks), data)
+        self.assertTrue(all(block.endswith(b"\n") for block in blocks))
+        self.assertEqual(list(baker.lineblocks(io.BytesIO(b""), 100)), [b""])
+
+        b = baker.Baker()
+        b.command(count_lines, split_input="lines", workers=2,
+                  reducer=operator.add)
+        b.command(count_lines, name="counts", split_input="lines",
+                  workers=2)
+        self.assertEqual(b.run(["s", "count_lines", path], main=False), 2000)
+        self.assertEqual(b.run(["s", "count_lines", path, "x x x"],
+                               main=False), 2000 * 4 // 7)
+        self.assertEqual(sum(b.run(["s", "counts", path], main=False)), 2000)
+        with open(path + ".gz", "wb") as fobj:
+            fobj.write(gzip_bytes(data))
+        self.assertEqual(b.run(["s", "count_lines", path + ".gz"],
+                               main=False), 2000)
+        self.assertRaises(ValueError, b.run,
+                          ["s", "count_lines", path, "bad"], main=False)
+        self.assertRaises(baker.CommandError, b.command, count_lines,
+                          split_input="missing")
+        b.command(lambda lines=None: 0, name="optional",
+                  split_input="lines")
+        self.assertRaises(baker.CommandError, b.run, ["s", "optional"],
+                          main=False)
+        self.assertRaises(baker.CommandError, b.command, count_lines,
+                          split_input="lines", files={"lines": "r"})
+        self.assertRaises(baker.CommandError, b.command,
+                          lambda lines, dst: None, split_input="lines",
+                          files={"dst": "w"})
+        shutil.rmtree(tempdir)
+
+    @unittest.skipIf(not hasattr(baker.inspect, "isasyncgen"),
+                     "requires Python 3.6+")
+    def test_async(self):
+        """Test coroutine and async generator commands"""
+        # Compiled at runtime so this file still imports on Python 2
+        namespace = {"cleanup": []}
+        exec("import asyncio\n"
+             "async def double(n, delay=0.0):\n"
+             "    await asyncio.sleep(float(delay))\n"
+             "    return int(n) * 2\n"
+             "async def count(stop=3):\n"
+             "    try:\n"
+             "        for i in range(stop):\n"
+             "            await asyncio.sleep(0)\n"
+             "            yield i\n"
+             "    finally:\n"
+             "        cleanup.append(True)\n", namespace)
+        b = baker.Baker()
+        b.command(namespace["double"])
+        b.command(namespace["count"])
+
+        self.assertEqual(b.run(["s", "double", "4"], main=False), 8)
+        out = StringIO()
+        self.assertTrue(isinstance(b.run(["s", "count"], outfile=out),
+                                   baker.AsyncIterator))
+        self.assertEqual(out.getvalue(), "0\n1\n2\n")
+        self.assertEqual(namespace["cleanup"], [True])
+
+        argvs = [["s", "double", str(n), "--delay", "0.1"] for n in range(20)]
+        start = time.time()
+        results = list(b.run_many_async(argvs, limit=10))
+        # Two rounds of ten concurrent sleeps
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertEqual([r.value for r in results],
+                         [n * 2 for n in range(20)])
+        self.assertEqual([r.item for r in results], argvs)
+
+        results = dict((r.item[2], r) for r in b.run_many_async(
+            [["s", "double", "x"], ["s", "double", "1"]], ordered=False))
+        self.assertEqual(results["1"].value, 2)
+        self.assertTrue(isinstance(results["x"].exception, ValueError))
+
     def test_global_options_get(self):
         b = baker.Baker()
         self.assertEqual(b.get('a', 5), 5)
@@ -603,6 +1754,31 @@ class TestBaker(unittest.TestCase):
         b.run(["script.py", "open", "--help"], helpfile=out)
         self.assertEqual(out.getvalue(), COMMAND_HELP)
 
+    def test_help_cache(self):
+        """Test that rendered help is cached until a command is added"""
+        b = build_baker()
+        writes = []
+
+        class Recorder(object):
+            mode = "w"
+
+            def write(self, content):
+                writes.append(content)
+
+        b.run(["script.py", "--help"], helpfile=Recorder())
+        b.run(["script.py", "open", "--help"], helpfile=Recorder())
+        self.assertEqual(writes, [MAIN_HELP, COMMAND_HELP])
+        self.assertEqual(set(b._helpcache),
+                         set([("script.py", None), ("script.py", "open")]))
+
+        @b.command
+        def close():
+            "Close it."
+
+        self.assertEqual(b._helpcache, {})
+        b.run(["script.py", "--help"], helpfile=Recorder())
+        self.assertTrue(" close  Close it.\n" in writes[-1])
+
     def test_writeconfig(self):
         """Test Baker.writeconfig()"""
         b = build_baker()